@@ -9,6 +9,8 @@ import sorter_anonymizer      # sort and quarantine dicoms
 import anonymize_dicoms       # anonymize dicoms
 import find_pid_modality    # sort dicoms into secondary modalities and pid
 import post_process
+import download_monitor       # wait for pacs downloads to finish
+import stream_pipeline        # process studies while others download
 
 # --- import pacs libraries
 import pacs_tools
@@ -24,6 +26,10 @@ paths = yaml.load(open(ANON_ROOT_PATH + '/config/config.yml', 'r'), Loader=yaml.
 CSV_PATH = paths['CSV_PATH']
 ACC_CSV_PATH = paths['ACC_CSV_PATH']
 PACS_DL_PATH = paths['PACS_DL_PATH']
+CFIND_CACHE_PATH = paths.get('CFIND_CACHE_PATH', None)
+CFIND_CACHE_TTL = paths.get('CFIND_CACHE_TTL', 86400)
+DOWNLOAD_STALL_TIMEOUT = paths.get('DOWNLOAD_STALL_TIMEOUT', download_monitor.STALL_TIMEOUT)
+SCRUB_TRANSFER_SYNTAX = paths.get('SCRUB_TRANSFER_SYNTAX', post_process.OUTPUT_TRANSFER_SYNTAX)
 
 # --- requestor related globals
 DATE = sys.argv[1]
@@ -42,7 +48,10 @@ flag_synonyms = {
     '-privonly' : 'p',
     '-shift' : 's',
     '-custom': 'c',
-    '-killdl': 'k'
+    '-killdl': 'k',
+    '-resume': 'u',
+    '-refresh': 'f',
+    '-stream': 't'
 }
 
 flag_rules = {
@@ -54,7 +63,10 @@ flag_rules = {
     'p': 'PRIVONLY',
     's': 'SHIFT',
     'c': 'CUSTOM',
-    'k': 'KILL_DOWNLOAD'
+    'k': 'KILL_DOWNLOAD',
+    'u': 'RESUME',
+    'f': 'REFRESH',
+    't': 'STREAM'
 }
 
 flag_vars = {
@@ -66,7 +78,10 @@ flag_vars = {
     'PRIVONLY': False,
     'SHIFT': False,
     'CUSTOM': False,
-    'KILL_DOWNLOAD': False
+    'KILL_DOWNLOAD': False,
+    'RESUME': False,
+    'REFRESH': False,
+    'STREAM': False
 }
 
 # --- check if any flags are given
@@ -94,6 +109,29 @@ if len(sys.argv) > 3:
 
                 flag_vars[flag_rules[flag]] = True
 
+# ----------------------------------------------
+# PIPELINE HELPERS
+# ----------------------------------------------
+
+def load_scrub_rules():
+
+    return post_process.prepare_yaml(ANON_ROOT_PATH + '/rules/da-pixel.yml')
+
+def load_anonymizer():
+
+    # --- use custom smaller set of rules for a lighter scrub
+    if flag_vars['CUSTOM']:
+        rules_csv = ANON_ROOT_PATH + '/rules/custom_rules.csv'
+    else:
+        rules_csv = ANON_ROOT_PATH + '/rules/standard_rules.csv'
+
+    # --- remove only private tags
+    if flag_vars['PRIVONLY'] and not flag_vars['CUSTOM']:
+        print('Keep private tags mode.')
+
+    # --- load rules and salt once and determine if date shift functionality will be used
+    return anonymize_dicoms.Anonymizer(rules_csv, remove_non_standard=not flag_vars['PRIVONLY'], shift=flag_vars['SHIFT'])
+
 # ----------------------------------------------
 # PIPELINE PROCESS
 # ----------------------------------------------
@@ -102,9 +140,24 @@ for mode, boolean in flag_vars.items():
     if boolean:
         print('RUNNING: ' + mode)
 
+# --- resume an interrupted scrub / anonymization of files already in mirc/anon
+if flag_vars['RESUME']:
+    flag_vars['KILL_DOWNLOAD'] = True
+
+    # --- a streaming run journals each study under mirc/logs/stream/<acc>/, which the
+    #     resume below does not read (finished files would be anonymized a second time)
+    if os.path.isdir(ANON_ROOT_PATH + '/mirc/logs/stream'):
+        sys.exit('Cannot resume a streaming (-t) run, its per-study journals are in mirc/logs/stream. Rerun the request.')
+
 # --- clean directories
-cleandirs.clean(ANON_ROOT_PATH + '/mirc')
-cleandirs.clean(ANON_ROOT_PATH + '/flat')
+else:
+    cleandirs.clean(ANON_ROOT_PATH + '/mirc')
+    cleandirs.clean(ANON_ROOT_PATH + '/flat')
+
+# --- streaming needs the download and sorting steps
+if flag_vars['STREAM'] and (flag_vars['KILL_DOWNLOAD'] or flag_vars['NOSORT']):
+    print('Streaming mode requires download and sorting, running steps one after another.')
+    flag_vars['STREAM'] = False
 
 # --- perform pacs query and generate matches, exclude, missing csv files
 requestor_path = CSV_PATH + DATE + '/' + REQUESTOR
@@ -113,9 +166,9 @@ if not flag_vars['KILL_DOWNLOAD']:
 
     # --- choose which download.py file to use based on flags
     if flag_vars['ACCESSION']:
-        download_acc.main(root=requestor_path)
+        download_acc.main(root=requestor_path, cache_path=CFIND_CACHE_PATH, cache_ttl=CFIND_CACHE_TTL, refresh=flag_vars['REFRESH'])
     else:
-        download.main(root=requestor_path)
+        download.main(root=requestor_path, cache_path=CFIND_CACHE_PATH, cache_ttl=CFIND_CACHE_TTL, refresh=flag_vars['REFRESH'])
 
     # --- copy files to workstation if MOUNT is activated. Mounted path specific
     if flag_vars['MOUNT']:
@@ -136,12 +189,26 @@ if not flag_vars['KILL_DOWNLOAD']:
         subprocess.run('cp -r /data/dicom/mirc_csvs/* ' + requestor_path + '/csvs/', shell=True)
         subprocess.run('rm -rf /data/dicom/mirc_csvs/*', shell=True)
 
-    # --- begin download from pacs. continue pipeline when download is finished (tracked by countv2.sh)
-    pacs_tools.main(requestor_path)
-    subprocess.run([ANON_ROOT_PATH + '/scripts/countv2.sh', PACS_DL_PATH, 'downloaded'])
+    if flag_vars['STREAM']:
+
+        # --- sort, scrub and anonymize each study as soon as it is downloaded
+        pipeline = stream_pipeline.StudyPipeline(ANON_ROOT_PATH + '/mirc', PACS_DL_PATH, 
+            rules=None if flag_vars['RAW'] else load_scrub_rules(), 
+            anonymizer=None if flag_vars['RAW'] else load_anonymizer(), 
+            transfer_syntax=SCRUB_TRANSFER_SYNTAX)
+        pacs_tools.main(requestor_path, on_complete=pipeline.submit)
+        shifted_dates_dict = pipeline.finish()
+
+    else:
+
+        # --- begin download from pacs. continue pipeline when the moved studies have arrived
+        statuses = pacs_tools.main(requestor_path)
+        download_monitor.main(PACS_DL_PATH, statuses, stall_timeout=DOWNLOAD_STALL_TIMEOUT)
 
 # --- determine if secondaries and foreign files will be removed with "no sort" flag
-if not flag_vars['NOSORT']:
+if flag_vars['RESUME'] or flag_vars['STREAM']:
+    pass
+elif not flag_vars['NOSORT']:
 
     # --- recursively move files from PACS download area to PROCESS AREA
     subprocess.run('mv ' + PACS_DL_PATH + '* ' + ANON_ROOT_PATH + '/mirc/flat/', shell=True)
@@ -159,12 +226,12 @@ if not flag_vars['NOSORT']:
     
     try:
         # --- post process secondaries if request contains modalities with secondary images
-        if not flag_vars['RAW']:
+        if not flag_vars['RAW'] and not flag_vars['STREAM']:
             
-            rules = post_process.prepare_yaml(ANON_ROOT_PATH + '/rules/da-pixel.yml')
+            rules = load_scrub_rules()
 
             # post_process.anonymize_all(scrub_dict, rules)
-            post_process.anonymize(ANON_ROOT_PATH + '/mirc/anon', rules)
+            post_process.anonymize(ANON_ROOT_PATH + '/mirc/anon', rules, resume=flag_vars['RESUME'], transfer_syntax=SCRUB_TRANSFER_SYNTAX)
     except:
         print('POST PROCESS ERROR. Secondary scrub not performed.')
 
@@ -174,42 +241,11 @@ if not flag_vars['NOSORT']:
         if bool(pid_dict):
             find_pid_modality.convert_acc_to_pid_folders(pid_dict, ANON_ROOT_PATH)
 
-# --- anonymize dicom files using rules based on flags
-if not flag_vars['RAW']:
-
-    # --- use custom smaller set of rules for a lighter scrub
-    if flag_vars['CUSTOM']:
+# --- anonymize dicom files using rules based on flags (already done per study when streaming)
+if not flag_vars['RAW'] and not flag_vars['STREAM']:
 
-        if flag_vars['PRIVONLY']:
-            
-            if flag_vars['SHIFT']:
-                shifted_dates_dict = anonymize_dicoms.anonymize(ANON_ROOT_PATH + '/mirc/anon', ANON_ROOT_PATH + '/rules/custom_rules.csv', remove_non_standard=False, shift=True)
-            else:
-                anonymize_dicoms.anonymize(ANON_ROOT_PATH + '/mirc/anon', ANON_ROOT_PATH + '/rules/custom_rules.csv', remove_non_standard=False, shift=False)
-
-        elif flag_vars['SHIFT']:
-            shifted_dates_dict = anonymize_dicoms.anonymize(ANON_ROOT_PATH + '/mirc/anon', ANON_ROOT_PATH + '/rules/custom_rules.csv', remove_non_standard=True, shift=True)
-        else:
-            anonymize_dicoms.anonymize(ANON_ROOT_PATH + '/mirc/anon', ANON_ROOT_PATH + '/rules/custom_rules.csv', remove_non_standard=True, shift=False)
-
-    # --- remove only private tags
-    elif flag_vars['PRIVONLY']:
-        print('Keep private tags mode.')
-        if flag_vars['SHIFT']:
-            shifted_dates_dict = anonymize_dicoms.anonymize(ANON_ROOT_PATH + '/mirc/anon', ANON_ROOT_PATH + '/rules/standard_rules.csv', remove_non_standard=False, shift=True)
-
-        else:
-            anonymize_dicoms.anonymize(ANON_ROOT_PATH + '/mirc/anon', ANON_ROOT_PATH + '/rules/standard_rules.csv', remove_non_standard=False, shift=False)
-
-    else:
-
-        # --- determine if date shift functionality will be used
-        if flag_vars['SHIFT']:
-            shifted_dates_dict = anonymize_dicoms.anonymize(ANON_ROOT_PATH + '/mirc/anon', ANON_ROOT_PATH + '/rules/standard_rules.csv', remove_non_standard=True, shift=True)
-
-        # --- otherwise run normal anonymization
-        else:
-            anonymize_dicoms.anonymize(ANON_ROOT_PATH + '/mirc/anon', ANON_ROOT_PATH + '/rules/standard_rules.csv', remove_non_standard=True, shift=False)
+    anonymizer = load_anonymizer()
+    shifted_dates_dict = anonymize_dicoms.anonymize(ANON_ROOT_PATH + '/mirc/anon', anonymizer=anonymizer, resume=flag_vars['RESUME'])
 
 # --- create spreadsheet mapping PIDs to shifted dates if shifted functionality was used
 if flag_vars['SHIFT']:
@@ -218,17 +254,21 @@ if flag_vars['SHIFT']:
     df_q = pd.read_csv(requestor_path + '/csvs/query_' + DATE + '.csv', index_col=[0])
     df_m = pd.read_csv(requestor_path + '/csvs/matches_' + DATE + '.csv')
     
+    # --- days shifted per patient. normalize PatientIDs since csv MRNs lose leading zeros
+    normalize = lambda mrn : str(mrn).strip().lstrip('0')
+    shifted_days = {normalize(pid) : days for pid, days in shifted_dates_dict.items()}
+
     # --- create shifted study dates column
     shifted_dates_list = []
-    for d in df_m['study_date']:
+    for mrn, d in zip(df_m['mrn'], df_m['study_date']):
         
         # --- convert to str
         d = str(d)
 
         # --- append 
-        if d in shifted_dates_dict.keys():
-            shifted_dates_list.append(shifted_dates_dict[d])
-        else:
+        try:
+            shifted_dates_list.append(anonymize_dicoms.shift_da(d, shifted_days[normalize(mrn)]))
+        except (KeyError, ValueError):
             shifted_dates_list.append('None')
 
     df_q_ = pd.DataFrame(data={'mrn' : df_q['MRN'], 'pid' : df_q['Patient Study ID']})
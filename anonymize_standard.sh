@@ -21,6 +21,9 @@ OPTIONS:
   -d                used by caidm workstation script to mount files
   -l                anonymize using lighter rules
   -r                no anonymization will be performed
+  -u                resume an interrupted scrub / anonymization (skips download and sorting)
+  -f                refresh: ignore cached C-FIND results and query the PACS again
+  -t                stream: sort, scrub and anonymize each study while the rest of the request downloads
 "
 
   usage() {
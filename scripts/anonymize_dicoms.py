@@ -4,10 +4,12 @@ import random
 from pydicom.uid import UID
 from pydicom.tag import Tag
 import pandas as pd
-import sys, os
+import sys, os, shutil, struct
+import multiprocessing, functools
 import numpy as np
 import time, datetime
 from hash import hash
+from journal import Journal, replace, atomic_save, TMP_SUFFIX
 #################################################################
 # This file is used to remove or hash tags of interest from 
 # dicom files. The tags are fed through a csv file with the columns
@@ -19,83 +21,338 @@ from hash import hash
 MIN_SHIFT_DAYS = -1000
 MAX_SHIFT_DAYS = 1000
 SALT_PATH = '/data/apps/DICOMPipeline/anon_pipeline/rules/secret'
+
+# --- tag actions, in order of precedence if a tag is listed in more than one column
+ACTIONS = ['hashptid', 'hashuid', 'shift', 'remove']
+
+# --- Anonymizer context and run journal of a worker process (see set_anonymizer)
+ANONYMIZER = None
+JOURNAL = None
+
+# --- prefix for hashing UIDs and max number of hashed values memoized per process
+UID_PREFIX = '1.2.840.10008.'
+HASH_CACHE_SIZE = 65536
+
+# --- pixel data elements (PixelData, FloatPixelData, DoubleFloatPixelData) and 
+#     explicit VRs with a 4 byte length
+PIXEL_DATA_TAGS = [0x7fe00010, 0x7fe00008, 0x7fe00009]
+LONG_LENGTH_VRS = [b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'UC', b'UN', b'UR', b'UT']
+DEFLATED_TRANSFER_SYNTAX = '1.2.840.10008.1.2.1.99'
+#################################################################
+# Anonymizer context
+#################################################################
+class Anonymizer():
+    """
+    Holds everything needed to anonymize dicoms that is loaded once per run
+    (salt, compiled tag plan and hashing / date shifting state) so it can be
+    reused for every file and shared with worker processes.
+    """
+
+    def __init__(self, csv_file_path, remove_non_standard=True, shift=False, salt_path=SALT_PATH, defer_pixels=True):
+
+        self.remove_non_standard = remove_non_standard
+        self.shift = shift
+
+        # --- copy pixel data bytes from the source file instead of loading them
+        self.defer_pixels = defer_pixels
+
+        # --- compile tags from csv file into (tag, action) plan
+        self.tag_plan = compile_tags(csv_file_path)
+
+        # --- read salt from text file
+        self.salt = load_salt(salt_path)
+
+        # --- per patient date shifting
+        self.date_shifter = DateShifter(self.salt)
+
+class DateShifter():
+    """
+    Shifts DA / DT values by a random number of days that is fixed per
+    patient (seeded by PatientID and salt). Each patient's offset is 
+    computed once and cached in self.offsets (PatientID --> days).
+    """
+
+    def __init__(self, salt, min_days=MIN_SHIFT_DAYS, max_days=MAX_SHIFT_DAYS):
+
+        self.salt = salt
+        self.min_days = min_days
+        self.max_days = max_days
+        self.offsets = {}
+
+    def offset(self, pid):
+        """
+        Returns the number of days to shift dates of a patient.
+        """
+        if pid not in self.offsets:
+            self.offsets[pid] = random.Random(str(pid) + self.salt).randint(self.min_days, self.max_days)
+
+        return self.offsets[pid]
+
+    def shift(self, value, pid, vr='DA'):
+        """
+        Shifts a DA / DT value (or list of values). TM values are returned
+        unchanged since whole day offsets do not change the time of day.
+        Raises ValueError if a value cannot be parsed.
+        """
+        if vr == 'TM':
+            return value
+
+        shift_func = shift_dt if vr == 'DT' else shift_da
+        days = self.offset(pid)
+
+        if isinstance(value, str):
+            return shift_func(value, days)
+
+        return [shift_func(v, days) for v in value]
+
 #################################################################
 # Main functions
 #################################################################
-def anonymize(root_folder_path, csv_file_path, remove_non_standard=True, shift=False):
+def anonymize(root_folder_path, csv_file_path=None, remove_non_standard=True, shift=False, anonymizer=None, workers=None, resume=False, journal_path=None):
     """
     Anonymizes all .dcm files within the root folder given.
     
     Parameters:
     root_folder_path - the path to the folder containing all 
                        dicoms to be anonymized.
+    csv_file_path - the csv file with tags to anonymize (if no anonymizer is given)
+    anonymizer - an Anonymizer context; if None, one is created from
+                 csv_file_path, remove_non_standard and shift
+    workers - number of processes, each anonymizing whole series folders;
+              if None, use the number of cores
+    resume - if True, skip files finished by an interrupted run (see journal_path)
+    journal_path - journal of finished files; if None, uses 
+                   <root_folder_path>/../logs/anonymize_journal.txt
     """
-
-    # --- create dictionary for shift dates
-    shifted_dates_dict = {}
+    if anonymizer is None:
+        anonymizer = Anonymizer(csv_file_path, remove_non_standard=remove_non_standard, shift=shift)
 
     # --- inform the user of process
     print("Beginning tag removal anonymization process.")
 
-    if shift:
+    if anonymizer.shift:
         print("Utilizing date shifting pipeline.")
-    
-    # --- process tags from csv file to get tags to be removed/hashed
-    remove_tag, shift_tag, hashuid_tag, hashptid_tag = process_tags(csv_file_path)
-    
-    # --- parse the set into tag format
-    remove_tag_set = set(remove_tag)
-    shift_tag_set = set(shift_tag)
-    hashuid_tag_set = set(hashuid_tag)
-    hashptid_tag_set = set(hashptid_tag)
 
-    # --- traverse through the root folder, find all dcm files and anonymizes them
-    # salt_path = os.path.dirname(os.path.dirname(root_folder_path)) + '/rules/secret'
+    offsets = anonymizer.date_shifter.offsets
+
+    # --- open journal of finished files, finish interrupted writes
+    if journal_path is None:
+        journal_path = os.path.dirname(os.path.normpath(root_folder_path)) + '/logs/anonymize_journal.txt'
+    journal = Journal(journal_path, resume=resume)
+    journal.recover(root_folder_path)
+
+    # --- days shifted for patients finished before an interruption
+    offsets.update(journal.offsets)
+
+    # --- traverse through the root folder and group dcm files by folder
+    jobs = find_dicoms(root_folder_path)
+    if resume:
+        total = sum([len(dicom_paths) for dicom_paths in jobs])
+        jobs = [[p for p in dicom_paths if p not in journal] for dicom_paths in jobs]
+        jobs = [dicom_paths for dicom_paths in jobs if len(dicom_paths) > 0]
+        print("Resuming: " + str(total - sum([len(dicom_paths) for dicom_paths in jobs])) + " dicom files already anonymized.")
+
+    workers = (os.cpu_count() or 1) if workers is None else workers
 
     counter = 0
-    for root, directories, dcm_files in os.walk(root_folder_path): 
-        for dcm_file in dcm_files:
-            if dcm_file.endswith('.dcm'):
-                
-                # --- create the full path for the dicom file
-                dicom_path = os.path.join(root,dcm_file)
-                
-                # --- read dicom with pydicom
-                data = pydicom.dcmread(dicom_path)
-                
-                # --- read salt from text file
-                file_object = open(SALT_PATH, 'r')
-                salt = file_object.readline()
+    cache_info = {}
+    if workers > 1 and len(jobs) > 1:
+
+        # --- anonymize folders in parallel and merge shifted dates from each worker
+        with multiprocessing.Pool(processes=workers, initializer=set_anonymizer, initargs=(anonymizer, journal)) as pool:
+            for count, worker_offsets, (pid, info) in pool.imap_unordered(anonymize_files, jobs):
+                offsets.update(worker_offsets)
+                cache_info[pid] = info
+
+                # --- keep track of how many dicom files have been anonymized
+                counter += count
+                print(str(counter) + " dicom files anonymized.", end='\r')
+
+    else:
+        for dicom_paths in jobs:
+            for dicom_path in dicom_paths:
+                anonymize_file(dicom_path, anonymizer, journal)
 
-                # --- anonymize and hash tags of the dicom
-                anonymize_dicom(data, salt, remove_tag_set, shift_tag_set, hashuid_tag_set, hashptid_tag_set, remove_non_standard, shift, shifted_dates_dict)
-                
-                # --- save dicom file
-                data.save_as(dicom_path)
-                
                 # --- keep track of how many dicom files have been anonymized
                 counter += 1
                 print(str(counter) + " dicom files anonymized.", end='\r')
+
+        cache_info[os.getpid()] = hash_cache_info()
                 
     # --- inform the user of success
+    journal.finish()
     print()
     print("Successfully anonymized " + str(counter) + " dicom files.")
+
+    # --- report hash cache usage summed over all processes
+    for name in ['hashuid', 'hashptid']:
+        hits = sum([info[name][0] for info in cache_info.values()])
+        misses = sum([info[name][1] for info in cache_info.values()])
+        print("Hash cache (%s): %i hits, %i misses (maxsize %i)." % (name, hits, misses, HASH_CACHE_SIZE))
     
-    if shift:
-        return shifted_dates_dict
+    # --- return days shifted per patient (PatientID --> days)
+    if anonymizer.shift:
+        return offsets
+
+def anonymize_file(dicom_path, anonymizer, journal=None):
+    """
+    Anonymizes a single dcm file in place. The file is replaced atomically
+    and recorded in the journal (if given).
+    """
+    # --- rewrite header only and stream pixel data if possible
+    if anonymizer.defer_pixels and anonymize_header(dicom_path, anonymizer, journal):
+        return
+
+    # --- read dicom with pydicom
+    data = pydicom.dcmread(dicom_path)
+
+    # --- anonymize and hash tags of the dicom
+    anonymize_dicom(data, anonymizer)
+    record_offsets(anonymizer, journal)
+    
+    # --- save dicom file
+    atomic_save(data, dicom_path, journal)
+
+def anonymize_header(dicom_path, anonymizer, journal=None):
+    """
+    Anonymizes a single dcm file in place without loading its pixel data.
+    Only the header is parsed and anonymized; the original pixel data 
+    element is then copied byte for byte from the source file.
+
+    Returns False (and leaves the file untouched) if the pixel data is not 
+    the last element of the file or the file cannot be streamed (e.g. deflated).
+    """
+    with open(dicom_path, 'rb') as fp:
+
+        # --- read header, pydicom leaves the file at the start of the pixel data element
+        data = pydicom.dcmread(fp, stop_before_pixels=True)
+        offset = fp.tell()
+
+        if 'TransferSyntaxUID' in data.file_meta and data.file_meta.TransferSyntaxUID == DEFLATED_TRANSFER_SYNTAX:
+            return False
+
+        end = find_pixel_data_end(fp, offset, data.is_little_endian, data.is_implicit_VR)
+        if end is None or end != os.fstat(fp.fileno()).st_size:
+            return False
+
+    # --- anonymize and hash tags of the dicom
+    anonymize_dicom(data, anonymizer)
+    record_offsets(anonymizer, journal)
+
+    # --- save header to a temporary file, append original pixel data and replace
+    tmp_path = dicom_path + TMP_SUFFIX
+    data.save_as(tmp_path)
+    with open(tmp_path, 'ab') as dst, open(dicom_path, 'rb') as src:
+        src.seek(offset)
+        shutil.copyfileobj(src, dst)
+
+    replace(tmp_path, dicom_path, journal)
+
+    return True
 
-def anonymize_dicom(dicom, salt, remove_tag_set, shift_tag_set, hashuid_tag_set, hashptid_tag_set, remove_non_standard, shift, shifted_dates_dict):
+def record_offsets(anonymizer, journal=None):
     """
-    Helper function to remove tags given by the list tags_to_anonymize.
+    Records new days shifted per patient in the journal before the file 
+    using them is marked as finished.
+    """
+    if journal is None or not anonymizer.shift:
+        return
+
+    # --- offsets only grow, so equal sizes mean nothing new to record
+    offsets = anonymizer.date_shifter.offsets
+    if len(offsets) == len(journal.offsets):
+        return
+
+    for pid, days in offsets.items():
+        if journal.offsets.get(pid) != days:
+            journal.shift(pid, days)
+
+def find_pixel_data_end(fp, offset, is_little_endian=True, is_implicit_VR=False):
+    """
+    Finds the end of the pixel data element that starts at offset without
+    reading its value (items of encapsulated pixel data are skipped).
+
+    Returns:
+    end - the file position after the pixel data element (offset if there is
+          no element at offset) or None if the element cannot be parsed
+    """
+    endian = '<' if is_little_endian else '>'
+
+    fp.seek(offset)
+    header = fp.read(8)
+    if len(header) == 0:
+        return offset
+    elif len(header) < 8:
+        return None
+
+    # --- check that element is pixel data
+    group, element = struct.unpack(endian + 'HH', header[:4])
+    if (group << 16 | element) not in PIXEL_DATA_TAGS:
+        return None
+
+    # --- read length
+    if is_implicit_VR:
+        length = struct.unpack(endian + 'L', header[4:])[0]
+    elif header[4:6] in LONG_LENGTH_VRS:
+        length = struct.unpack(endian + 'L', fp.read(4))[0]
+    else:
+        length = struct.unpack(endian + 'H', header[6:])[0]
+
+    if length != 0xFFFFFFFF:
+        return fp.tell() + length
+
+    # --- undefined length (encapsulated), skip items until sequence delimiter
+    while True:
+        item = fp.read(8)
+        if len(item) < 8:
+            return None
+
+        group, element, length = struct.unpack(endian + 'HHL', item)
+        if (group, element) == (0xFFFE, 0xE0DD):
+            return fp.tell()
+        elif (group, element) != (0xFFFE, 0xE000):
+            return None
+
+        fp.seek(length, 1)
+
+def anonymize_files(dicom_paths):
+    """
+    Worker function to anonymize a list of dcm files (one folder) with the 
+    Anonymizer context of the current process.
+
+    Returns:
+    count - number of dicom files anonymized
+    offsets - days shifted per patient in this process (PatientID --> days)
+    (pid, cache_info) - process id and its hash cache counters (see hash_cache_info)
+    """
+    for dicom_path in dicom_paths:
+        anonymize_file(dicom_path, ANONYMIZER, JOURNAL)
+
+    return len(dicom_paths), ANONYMIZER.date_shifter.offsets, (os.getpid(), hash_cache_info())
+
+def set_anonymizer(anonymizer, journal=None):
+    """
+    Sets the Anonymizer context and journal of the current process (used as process pool initializer).
+    """
+    global ANONYMIZER, JOURNAL
+    ANONYMIZER = anonymizer
+    JOURNAL = journal
+
+def anonymize_dicom(dicom, anonymizer):
+    """
+    Helper function to remove tags given by the compiled tag plan.
     Also removes private tags.
     
     Parameters:
     dicom - the dicom file thats being anonymized
-    tags_to_anonymize - a list of tags to anonymize
+    anonymizer - the Anonymizer context (salt, tag plan and shifting state)
     """
+    salt = anonymizer.salt
+    shift = anonymizer.shift
+
     # --- use pydicom's built in function to remove private tags
     try:
-        if remove_non_standard:
+        if anonymizer.remove_non_standard:
             dicom.remove_private_tags()
     except:
         pass
@@ -103,9 +360,6 @@ def anonymize_dicom(dicom, salt, remove_tag_set, shift_tag_set, hashuid_tag_set,
     # --- Change age
     dicom.PatientAge = '119Y'
     
-    # --- prefix for hashing UIDs
-    prefix = '1.2.840.10008.'
-    
     # --- extract patientid to use for shifting dates
     pid = dicom.PatientID
     
@@ -117,40 +371,33 @@ def anonymize_dicom(dicom, salt, remove_tag_set, shift_tag_set, hashuid_tag_set,
     #if 'ReferencedImageSequence' in dicom:
     #    del dicom.ReferencedImageSequence
 
-    # --- iterrate through dicom and remove tags
-    for tag in dicom:
+    # --- visit only the tags in the plan that are present in the dicom
+    for current_tag, action in anonymizer.tag_plan:
 
-        # --- get current tag
-        current_tag = tag.tag
+        if current_tag not in dicom:
+            continue
         
         # --- check if it is a tag in hashptid
-        if str(current_tag) in hashptid_tag_set:
-            dicom[current_tag].value = hash(dicom[current_tag].value)
+        if action == 'hashptid':
+            dicom[current_tag].value = hash_ptid(dicom[current_tag].value)
             
         # --- check if it is a tag in hashuid
-        elif str(current_tag) in hashuid_tag_set:
-            suffix = str(int(hash(str(dicom[current_tag].value) + salt), 16))
-            dicom[current_tag].value = prefix + suffix
+        elif action == 'hashuid':
+            dicom[current_tag].value = hash_uid(str(dicom[current_tag].value), salt)
 
         # --- check if it is a tag in date shift
-        elif str(current_tag) in shift_tag_set:
+        elif action == 'shift':
 
             if shift:
-                current_date = dicom[current_tag].value
-                
-                if current_date not in shifted_dates_dict.keys():
+                element = dicom[current_tag]
 
-                    try:
-                        shifted_date = shift_date(dicom, current_tag, salt, pid)
-                        dicom[current_tag].value = shifted_date
-                        shifted_dates_dict[current_date] = shifted_date
-                    except:
-                        pass
-                else:
-                    dicom[current_tag].value = shifted_dates_dict[current_date]
+                try:
+                    element.value = anonymizer.date_shifter.shift(element.value, pid, element.VR)
+                except ValueError:
+                    pass
 
         # --- check if it is a tag in remove
-        elif str(current_tag) in remove_tag_set:
+        elif action == 'remove':
             dicom[current_tag].value = ''
             
 def anonymize_private_tags_only(root_folder_path):
@@ -214,21 +461,109 @@ def process_tags(tag_csv_file):
 
     return remove_tags, shift_tags, hashuid_tags, hashptid_tags
 
-def shift_date(dicom, current_tag, salt, pid):
-    
-    # --- extract date value
-    date = dicom[current_tag].value
-    
-    # --- get number of days to shift
-    random.seed(str(pid) + salt)
-    days_to_shift = random.randint(MIN_SHIFT_DAYS, MAX_SHIFT_DAYS)
+@functools.lru_cache(maxsize=HASH_CACHE_SIZE)
+def hash_uid(uid, salt):
+    """
+    Hashes a UID with the salt into a new UID (memoized since the same study,
+    series and frame of reference UIDs repeat for every instance).
+    """
+    suffix = str(int(hash(uid + salt), 16))
 
-    # --- convert date to datetime and add
-    date = datetime.datetime.strptime(date, '%Y%m%d')
-    shifted_date = date + datetime.timedelta(days=days_to_shift)
-    shifted_date = shifted_date.strftime('%Y%m%d')
+    return UID_PREFIX + suffix
 
-    return shifted_date
+@functools.lru_cache(maxsize=HASH_CACHE_SIZE)
+def hash_ptid(ptid):
+    """
+    Hashes a patient id (memoized since it repeats for every instance).
+    """
+    return hash(ptid)
+
+def hash_cache_info():
+    """
+    Returns the (hits, misses) counters of the hash caches of the current process.
+    """
+    return {
+        'hashuid': tuple(hash_uid.cache_info()[:2]),
+        'hashptid': tuple(hash_ptid.cache_info()[:2])}
+
+def find_dicoms(root_folder_path):
+    """
+    Finds all .dcm files within the root folder, grouped by folder
+    (e.g. series) so that each group can be anonymized by one worker.
+
+    Returns:
+    jobs - a list of lists of dcm paths
+    """
+    jobs = []
+    for root, directories, dcm_files in os.walk(root_folder_path):
+        dicom_paths = [os.path.join(root, f) for f in sorted(dcm_files) if f.endswith('.dcm')]
+        if len(dicom_paths) > 0:
+            jobs.append(dicom_paths)
+
+    return jobs
+
+def load_salt(salt_path=SALT_PATH):
+    """
+    Reads the salt used for hashing from the first line of a text file.
+    """
+    with open(salt_path, 'r') as file_object:
+        return file_object.readline()
+
+def parse_tag(tag):
+    """
+    Converts string based tag (e.g. '(0010, 0020)') to an integer tag.
+    """
+    tag = tag.strip().strip('()[]').replace(' ', '')
+
+    if ',' in tag:
+        group, element = tag.split(',')
+        return Tag(int(group, 16), int(element, 16))
+
+    return Tag(int(tag, 16))
+
+def compile_tags(tag_csv_file):
+    """
+    Compiles the tag csv file once into a plan of integer tags and actions
+    ('remove', 'shift', 'hashuid' or 'hashptid'). If a tag is in more than
+    one column, the action with the highest precedence in ACTIONS is used.
+
+    Returns:
+    tag_plan - a list of (tag, action) sorted by tag
+    """
+    remove_tags, shift_tags, hashuid_tags, hashptid_tags = process_tags(tag_csv_file)
+
+    columns = {
+        'remove': remove_tags,
+        'shift': shift_tags,
+        'hashuid': hashuid_tags,
+        'hashptid': hashptid_tags}
+
+    # --- apply lowest precedence first so higher precedence actions overwrite
+    actions = {}
+    for action in reversed(ACTIONS):
+        for tag in columns[action]:
+            if isinstance(tag, str) and len(tag.strip()) > 0:
+                actions[parse_tag(tag)] = action
+
+    return sorted(actions.items())
+
+def shift_da(date, days):
+    """
+    Shifts a DA value (YYYYMMDD) by a number of days.
+    """
+    if len(date) != 8 or not date.isdigit():
+        raise ValueError('Invalid DA value: %s' % date)
+
+    date = datetime.date(int(date[:4]), int(date[4:6]), int(date[6:])) + datetime.timedelta(days=days)
+
+    return '%04i%02i%02i' % (date.year, date.month, date.day)
+
+def shift_dt(date_time, days):
+    """
+    Shifts the date part of a DT value (YYYYMMDDHHMMSS.FFFFFF&ZZXX) by a
+    number of days, keeping the time and offset suffix.
+    """
+    return shift_da(date_time[:8], days) + date_time[8:]
 
 if __name__ == '__main__':
     
@@ -236,16 +571,11 @@ if __name__ == '__main__':
         root_folder_path = sys.argv[1]
         csv_file_path = sys.argv[2]
 
-        if len(sys.argv) > 3:
-
-            flag = sys.argv[3]
-
-            if flag == '-s':
-                anonymize(root_folder_path, csv_file_path, remove_non_standard=True, shift=True)
-        else:
-            anonymize(root_folder_path, csv_file_path)
+        # --- optional flags: -s (shift dates), -r (resume interrupted run)
+        flags = sys.argv[3:]
+        anonymize(root_folder_path, csv_file_path, remove_non_standard=True, shift='-s' in flags, resume='-r' in flags)
     
     else:
         print("Incorrect usage.")
-        print("Usage: python anonymize_dicoms.py <root_folder> <csv_file>")
+        print("Usage: python anonymize_dicoms.py <root_folder> <csv_file> [-s] [-r]")
     
@@ -1,8 +1,15 @@
-import pandas as pd
+import pandas as pd, fnmatch
 import pacs, pacs_client
 
 # --- sets which PACS server to query from
 CONFIGS = 'vis'
+
+# --- number of C-FIND queries in flight (keep within the PACS association limit)
+CONCURRENCY = 4
+
+# --- on-disk C-FIND results cache (None disables it) and seconds before cached results expire
+CACHE_PATH = None
+CACHE_TTL = 86400
 class Client(pacs_client.Client):
 
     def parse_csv(self, fname):
@@ -35,6 +42,57 @@ class Client(pacs_client.Client):
 
         return queries
 
+    def plan_queries(self, queries):
+        """
+        Method to merge query rows sharing an MRN into a single C-FIND
+
+        The merged query uses the date range spanning all rows of the MRN and
+        a modality wildcard if the rows ask for different modalities. Results
+        are split back to the rows by assign_results()
+
+        """
+        groups = {}
+        for n, query in enumerate(queries):
+            groups.setdefault(query['mrn'], []).append(n)
+
+        planned = []
+        for mrn, group in groups.items():
+
+            q = queries[group[0]].copy()
+            if len(group) > 1:
+
+                dates = sorted(set([queries[n]['study_date'] for n in group]))
+                if len(dates) > 1:
+                    q['study_date'] = '%s-%s' % (dates[0], dates[-1])
+
+                if len(set([queries[n]['modality'] for n in group])) > 1:
+                    q['modality'] = '*'
+
+            planned.append(q)
+
+        return planned, list(groups.values())
+
+    def assign_results(self, queries, group, results):
+        """
+        Method to assign each result of a merged query to every row with the 
+        same study date and a matching modality (duplicate rows keep duplicate results)
+
+        """
+        # --- single rows were matched exactly by the PACS
+        if len(group) == 1:
+            return pacs_client.Client.assign_results(self, queries, group, results)
+
+        assigned = []
+        for n in group:
+            for i in range(len(results['studyUID'])):
+                date = results['study_date'][i].strip('\x00 ')
+                modality = results['modality'][i].strip('\x00 ')
+                if fnmatch.fnmatchcase(date, queries[n]['study_date']) and \
+                    fnmatch.fnmatchcase(modality, queries[n]['modality']):
+                    assigned.append((n, i))
+
+        return assigned
+
     def parse_mrn(self, value):
         truevalues = str(value).split('.')
         truevalues = [str(v) for v in truevalues]
@@ -137,11 +195,12 @@ class Client(pacs_client.Client):
                 if query.upper().find(s) > -1:
                     return s_list
 
-def main(root='.',argv = None):
+def main(root='.',argv = None, cache_path=CACHE_PATH, cache_ttl=CACHE_TTL, refresh=False):
     import sys 
     suffix = sys.argv[1] if len(sys.argv) > 1 else  ""
     client = Client(root=root, configs=CONFIGS)
-    client.perform_find(suffix=suffix)
+    cache = pacs.FindCache(cache_path, ttl=cache_ttl, refresh=refresh) if cache_path else None
+    client.perform_find(suffix=suffix, concurrency=CONCURRENCY, cache=cache)
  
 if __name__ == '__main__':
     # ===============================================================
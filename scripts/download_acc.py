@@ -3,6 +3,13 @@ import pacs, pacs_client
 import sys
 import os, glob
 CONFIGS = 'vis'
+
+# --- number of C-FIND queries in flight (keep within the PACS association limit)
+CONCURRENCY = 4
+
+# --- on-disk C-FIND results cache (None disables it) and seconds before cached results expire
+CACHE_PATH = None
+CACHE_TTL = 86400
 class Client(pacs_client.Client):
 
     def parse_csv(self, fname):
@@ -40,10 +47,11 @@ class Client(pacs_client.Client):
        return matches, exclude
 
    
-def main(root='.', argv = None):
+def main(root='.', argv = None, cache_path=CACHE_PATH, cache_ttl=CACHE_TTL, refresh=False):
     suffix = sys.argv[1] if len(sys.argv) > 1 else  ""
     client = Client(root=root, configs=CONFIGS)
-    client.perform_find(suffix=suffix)
+    cache = pacs.FindCache(cache_path, ttl=cache_ttl, refresh=refresh) if cache_path else None
+    client.perform_find(suffix=suffix, concurrency=CONCURRENCY, cache=cache)
  
 if __name__ == '__main__':
     # ===============================================================
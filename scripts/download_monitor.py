@@ -0,0 +1,181 @@
+# --------------------------------------------------
+#  Tracks dicoms arriving from PACS and decides when
+#  a download is complete.
+#
+#  With the C-MOVE status rows of pacs_client, only the
+#  folders of the moved studies are watched and each
+#  study is done once its folder stops changing. Without
+#  them, the whole download tree is scanned incrementally
+#  until no new files arrive for the stall timeout.
+#
+#  USAGE: download_monitor.py <download_path>
+# --------------------------------------------------
+import sys, os, time
+
+# --- seconds without any new file before a download is considered stalled
+STALL_TIMEOUT = 180
+
+# --- seconds a study folder must stay unchanged after its C-MOVE finished
+SETTLE = 5
+
+# --- seconds between scans
+INTERVAL = 2
+# --------------------------------------------------
+#  main function
+# --------------------------------------------------
+def main(root, studies=None, stall_timeout=STALL_TIMEOUT, settle=SETTLE, interval=INTERVAL):
+    """
+    Waits until the download in root is complete and returns the number of dicoms.
+
+    Parameters:
+    root - download folder (PACS_DL_PATH) sorted as root/mrn/accession/...
+    studies - status rows returned by pacs_client.Client.perform_move (None watches all of root)
+    stall_timeout - seconds without new files before giving up on the remaining studies
+    """
+    if studies is None:
+        count = wait_for_tree(root, stall_timeout, interval)
+    else:
+        counts = wait_for_studies(root, studies, stall_timeout, settle, interval)
+        count = sum(counts.values())
+
+    print(str(count) + ' total dicoms have been downloaded.')
+    print('PROCESS COMPLETE! :]')
+
+    return count
+
+def wait_for_studies(root, studies, stall_timeout=STALL_TIMEOUT, settle=SETTLE, interval=INTERVAL):
+    """
+    Watches the folders of moved studies until each stops changing. A study
+    is only done once it holds at least one dicom (and at least the instances
+    counted when its C-MOVE finished); empty studies stay pending until
+    nothing has arrived for stall_timeout seconds.
+
+    Returns:
+    counts - dictionary of (mrn, accession) -> number of dicoms
+    """
+    now = time.time()
+
+    # --- failed moves will not receive any files. pending: [count, last change, expected]
+    pending = {}
+    for study in studies:
+        if study['status'] != 'failed':
+            expected = max(1, int(study.get('instances', 0) or 0))
+            pending[(str(study['mrn']), str(study['accession']))] = [0, now, expected]
+
+    counts = {}
+    last_change = now
+    while len(pending) > 0:
+
+        now = time.time()
+        for key, (count, changed, expected) in list(pending.items()):
+
+            current = count_dcms('%s/%s/%s' % ((root,) + key))
+            if current != count:
+                pending[key] = [current, now, expected]
+                last_change = now
+
+            elif current >= expected and now - changed >= settle:
+                counts[key] = current
+                del pending[key]
+
+        print(str(len(counts)) + ' / ' + str(len(counts) + len(pending)) + ' studies downloaded.', end='\r')
+
+        # --- stop waiting if nothing arrives anymore
+        if len(pending) > 0 and now - last_change > stall_timeout:
+            print('\nDownload stalled, ' + str(len(pending)) + ' studies incomplete:')
+            for key, (count, changed, expected) in pending.items():
+                print('  ' + '/'.join(key) + ' (' + str(count) + ' dicoms)')
+                counts[key] = count
+            break
+
+        if len(pending) > 0:
+            time.sleep(interval)
+
+    print('')
+
+    return counts
+
+def wait_for_tree(root, stall_timeout=STALL_TIMEOUT, interval=INTERVAL):
+    """
+    Scans root until no new dicoms arrive for stall_timeout seconds. Only
+    folders whose modification time changed are listed again.
+
+    Returns:
+    count - number of dicoms in root
+    """
+    folders = {}
+    count = -1
+    last_change = time.time()
+    while True:
+
+        current = scan_tree(root, folders)
+        if current != count:
+            count = current
+            last_change = time.time()
+
+        print(str(count) + ' number of dicoms currently downloaded.', end='\r')
+
+        if time.time() - last_change > stall_timeout:
+            break
+
+        time.sleep(interval)
+
+    print('')
+
+    return count
+
+def scan_tree(root, folders):
+    """
+    Counts dicoms in root, updating folders (path -> (mtime, count)) in place.
+    """
+    total = 0
+    for path in list_folders(root):
+
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            continue
+
+        # --- list folder again only if its content changed
+        if path not in folders or folders[path][0] != mtime:
+            folders[path] = (mtime, count_files(path))
+
+        total += folders[path][1]
+
+    return total
+
+def list_folders(root):
+    """
+    Yields root and all folders below it.
+    """
+    stack = [root]
+    while len(stack) > 0:
+        path = stack.pop()
+        yield path
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+        except OSError:
+            pass
+
+def count_files(path):
+    """
+    Counts dicoms directly in path.
+    """
+    try:
+        with os.scandir(path) as entries:
+            return len([e for e in entries if e.name.endswith('.dcm') and e.is_file()])
+    except OSError:
+        return 0
+
+def count_dcms(path):
+    """
+    Counts dicoms in path and all folders below it.
+    """
+    return sum([count_files(p) for p in list_folders(path)])
+
+if __name__ == '__main__':
+
+    main(sys.argv[1])
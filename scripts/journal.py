@@ -0,0 +1,139 @@
+# --------------------------------------------------
+#  Atomic file writes and run journals used to
+#  resume an interrupted anonymization or scrub.
+#
+#  Files are written to <path>.tmp and renamed over
+#  the original. The journal records each rename:
+#
+#    BEGIN <path>       : <path>.tmp is complete, rename pending
+#    DONE <path>        : <path> is finished
+#    SHIFT <days> <pid> : dates of PatientID <pid> are shifted by <days>
+#    COMPLETE           : all files of the run are finished
+# --------------------------------------------------
+import os
+
+TMP_SUFFIX = '.tmp'
+
+class Journal():
+
+    def __init__(self, path, resume=False):
+        """
+        Opens a journal. If resume is False, any existing journal is discarded.
+        """
+        self.path = path
+        self.done = set()
+        self.pending = set()
+        self.offsets = {}
+        self.complete = False
+        self.file = None
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        if resume and os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    status, _, file_path = line.rstrip('\n').partition(' ')
+                    if status == 'BEGIN':
+                        self.pending.add(file_path)
+                    elif status == 'DONE':
+                        self.pending.discard(file_path)
+                        self.done.add(file_path)
+                    elif status == 'SHIFT':
+                        days, _, pid = file_path.partition(' ')
+                        self.offsets[pid] = int(days)
+                    elif status == 'COMPLETE':
+                        self.complete = True
+        else:
+            open(path, 'w').close()
+
+    def __contains__(self, path):
+
+        return os.path.abspath(path) in self.done
+
+    def __getstate__(self):
+
+        # --- file handle is reopened in each process
+        state = self.__dict__.copy()
+        state['file'] = None
+
+        return state
+
+    def write(self, line):
+
+        if self.file is None:
+            self.file = open(self.path, 'a')
+
+        self.file.write(line + '\n')
+        self.file.flush()
+
+    def begin(self, path):
+
+        self.write('BEGIN %s' % os.path.abspath(path))
+
+    def add(self, path):
+
+        path = os.path.abspath(path)
+        self.done.add(path)
+        self.write('DONE %s' % path)
+
+    def shift(self, pid, days):
+        """
+        Records the days the dates of a patient are shifted by, so a resumed
+        run knows the offsets of patients finished before the interruption.
+        """
+        if self.offsets.get(pid) != days:
+            self.offsets[pid] = days
+            self.write('SHIFT %i %s' % (days, pid))
+
+    def recover(self, root=None):
+        """
+        Finishes renames that were interrupted after the temporary file was
+        complete. Files without a BEGIN record are simply processed again and
+        their temporary files (if any) below root are removed.
+        """
+        for path in sorted(self.pending):
+            tmp_path = path + TMP_SUFFIX
+            if os.path.exists(tmp_path):
+                os.replace(tmp_path, path)
+            self.add(path)
+
+        self.pending = set()
+
+        # --- remove temporary files of writes interrupted before BEGIN
+        if root is not None:
+            for folder, directories, file_paths in os.walk(root):
+                for file_path in file_paths:
+                    if file_path.endswith(TMP_SUFFIX):
+                        os.remove(os.path.join(folder, file_path))
+
+    def finish(self):
+
+        self.complete = True
+        self.write('COMPLETE')
+        self.close()
+
+    def close(self):
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def replace(tmp_path, path, journal=None):
+    """
+    Renames a complete temporary file over path and records it in the journal.
+    """
+    if journal is not None:
+        journal.begin(path)
+
+    os.replace(tmp_path, path)
+
+    if journal is not None:
+        journal.add(path)
+
+def atomic_save(dcm, path, journal=None):
+    """
+    Saves a pydicom dataset to path without ever leaving a partially written file.
+    """
+    tmp_path = path + TMP_SUFFIX
+    dcm.save_as(tmp_path)
+    replace(tmp_path, path, journal)
@@ -3,7 +3,7 @@
 # https://github.com/peterchang77/
 # ------------------------------------------------------------------
 
-import gdcm, pandas as pd
+import gdcm, pandas as pd, queue, sqlite3, json, time, os
 
 # ================================================================== 
 # GLOBAL VARIABLES
@@ -57,11 +57,237 @@ def set_tag(ds, tag, value):
 
     return ds
 
+# ================================================================== 
+# SESSIONS
+# ================================================================== 
+
+class FindSession():
+    """
+    Class to keep a single association open for a series of C-FIND queries
+
+    The association is opened on first use and reopened (once per query)
+    if a query fails, e.g. after the PACS drops an idle association.
+
+    """
+    def __init__(self, configs, timeout=1000):
+
+        self.configs = configs
+        self.timeout = timeout
+        self.scu = None
+        self.uid = None
+
+    def connect(self, theQuery):
+        """
+        Method to open an association for the abstract syntax of theQuery
+
+        """
+        self.close()
+
+        scu = gdcm.ServiceClassUser()
+        scu.SetHostname(self.configs['ip'])
+        scu.SetPort(self.configs['port_called'])
+        scu.SetTimeout(self.timeout)
+        scu.SetCalling(self.configs['aet_calling'])
+        scu.SetCalled(self.configs['aet_called'])
+
+        if not scu.InitializeConnection():
+            raise ConnectionError('Could not connect to %s:%s' % (self.configs['ip'], self.configs['port_called']))
+
+        generator = gdcm.PresentationContextGenerator()
+        generator.GenerateFromUID(theQuery.GetAbstractSyntaxUID())
+        scu.SetPresentationContexts(generator.GetPresentationContexts())
+
+        if not scu.StartAssociation():
+            raise ConnectionError('Could not associate with %s' % self.configs['aet_called'])
+
+        self.scu = scu
+        self.uid = theQuery.GetAbstractSyntaxUID()
+
+    def find(self, theQuery):
+        """
+        Method to perform a single C-FIND, reconnecting and retrying once on failure
+
+        :return
+
+          (gdcm.DataSetArrayType) ret
+
+        """
+        for attempt in range(2):
+
+            ret = gdcm.DataSetArrayType()
+            try:
+                if self.scu is None or self.uid != theQuery.GetAbstractSyntaxUID():
+                    self.connect(theQuery)
+                if self.scu.SendFind(theQuery, ret):
+                    return ret
+
+            except ConnectionError:
+                if attempt > 0:
+                    raise
+
+            # --- drop broken association before retrying
+            self.close()
+
+        raise ConnectionError('C-FIND failed on %s' % self.configs['aet_called'])
+
+    def close(self):
+
+        if self.scu is not None:
+            try:
+                self.scu.StopAssociation()
+            except:
+                pass
+            self.scu = None
+
+    def __getstate__(self):
+
+        # --- associations are reopened in each process
+        state = self.__dict__.copy()
+        state['scu'] = None
+
+        return state
+
+class SessionPool():
+    """
+    Class to share a small pool of open C-FIND associations between callers
+
+    Sessions are created on demand up to size and reused for every query.
+
+    """
+    def __init__(self, configs, size=2, timeout=1000):
+
+        self.configs = configs
+        self.size = size
+        self.timeout = timeout
+        self.created = 0
+        self.idle = queue.Queue()
+
+    def acquire(self):
+
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        if self.created < self.size:
+            self.created += 1
+            return FindSession(self.configs, timeout=self.timeout)
+
+        return self.idle.get()
+
+    def release(self, session):
+
+        self.idle.put(session)
+
+    def find(self, theQuery):
+
+        session = self.acquire()
+        try:
+            return session.find(theQuery)
+        finally:
+            self.release(session)
+
+    def close(self):
+
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+
+    def __getstate__(self):
+
+        # --- each process opens its own sessions
+        return {'configs': self.configs, 'size': self.size, 'timeout': self.timeout}
+
+    def __setstate__(self, state):
+
+        self.__init__(**state)
+
+# ================================================================== 
+# CACHE
+# ================================================================== 
+
+class FindCache():
+    """
+    Class to store C-FIND results on disk (SQLite) keyed by PACS and normalized query
+
+    :params
+
+      (str) path : path to the *.sqlite file
+      (int) ttl : seconds a cached result stays valid
+      (bool) refresh : if True, ignore cached results (new results are still stored)
+
+    """
+    def __init__(self, path, ttl=86400, refresh=False):
+
+        self.path = path
+        self.ttl = ttl
+        self.refresh = refresh
+        self.conn = None
+
+    def connect(self):
+
+        if self.conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self.conn = sqlite3.connect(self.path, timeout=60)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS cfind (key TEXT PRIMARY KEY, created REAL, rows TEXT)')
+
+            # --- drop expired results so the cache does not grow without bound
+            self.conn.execute('DELETE FROM cfind WHERE created < ?', (time.time() - self.ttl,))
+            self.conn.commit()
+
+        return self.conn
+
+    def key(self, configs, query):
+        """
+        Method to create the cache key of a query on the PACS of configs
+
+        """
+        server = [configs['ip'], configs['port_called'], configs['aet_called']]
+        query = sorted([(tag, str(value).strip()) for tag, value in query.items()])
+
+        return json.dumps([server, query])
+
+    def get(self, configs, query):
+        """
+        Method to return cached result rows of query, or None if missing / expired
+
+        """
+        if self.refresh:
+            return None
+
+        row = self.connect().execute('SELECT created, rows FROM cfind WHERE key = ?', 
+            (self.key(configs, query),)).fetchone()
+
+        if row is None or time.time() - row[0] > self.ttl:
+            return None
+
+        return json.loads(row[1])
+
+    def put(self, configs, query, rows):
+
+        conn = self.connect()
+        conn.execute('INSERT OR REPLACE INTO cfind VALUES (?, ?, ?)', 
+            (self.key(configs, query), time.time(), json.dumps(rows)))
+        conn.commit()
+
+    def close(self):
+
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def __getstate__(self):
+
+        # --- connection is reopened in each process
+        state = self.__dict__.copy()
+        state['conn'] = None
+
+        return state
+
 # ================================================================== 
 # METHODS 
 # ================================================================== 
 
-def perform_find(configs, query={}, verbose=[], max_results=20, csv_file=None, results=None):
+def perform_find(configs, query={}, verbose=[], max_results=20, csv_file=None, results=None, session=None, cache=None):
     """
     Method to perform PACS query
 
@@ -86,6 +312,9 @@ def perform_find(configs, query={}, verbose=[], max_results=20, csv_file=None, r
       (int) max_results : if verbose list is provided, this value represents the max number of results to print 
       (str) csv_file : if provided, save results to provided path to *.csv file
       (dict) results : if provided, append current query result to existing results
+      (obj) session : if provided, a FindSession or SessionPool whose open associations are 
+        reused; otherwise a new association is made for this query
+      (obj) cache : if provided, a FindCache checked before querying the PACS
 
     :return
 
@@ -108,27 +337,39 @@ def perform_find(configs, query={}, verbose=[], max_results=20, csv_file=None, r
     if 'studyUID' not in results:
         results['studyUID'] = []
 
-    # --- Configure query object 
-    # --- use 'study' instead of gdcm.ePatientRootType
-    cnf = gdcm.CompositeNetworkFunctions()
-    theQuery = cnf.ConstructQuery(gdcm.ePatientRootType, gdcm.eStudy, ds)
+    # --- Check cache before touching the network
+    rows = cache.get(configs, query) if cache is not None else None
 
-    # --- Prepare the variable for output
-    ret = gdcm.DataSetArrayType()
-    
-    # --- Perform query
-    if len(verbose) > 0: print('Performing C-FIND...')
-    cnf.CFind(configs['ip'], configs['port_called'], theQuery, ret, configs['aet_calling'], configs['aet_called'])
+    if rows is None:
+
+        # --- Configure query object 
+        # --- use 'study' instead of gdcm.ePatientRootType
+        cnf = gdcm.CompositeNetworkFunctions()
+        theQuery = cnf.ConstructQuery(gdcm.ePatientRootType, gdcm.eStudy, ds)
+
+        # --- Perform query
+        if len(verbose) > 0: print('Performing C-FIND...')
+        if session is not None:
+            ret = session.find(theQuery)
+        else:
+            ret = gdcm.DataSetArrayType()
+            cnf.CFind(configs['ip'], configs['port_called'], theQuery, ret, configs['aet_calling'], configs['aet_called'])
+
+        # --- Extract values of the queried tags
+        rows = [dict([(tag, str(ret[i].GetDataElement(TAGS_GDCM(tag)).GetValue())) for tag in query]) for i in range(len(ret))]
+
+        if cache is not None:
+            cache.put(configs, query, rows)
 
     # --- Save/print output
-    if len(verbose) > 0: print('A total of %i matches found' % len(ret))
+    if len(verbose) > 0: print('A total of %i matches found' % len(rows))
 
     # --- Print results and save to dictionary 
-    for i in range(len(ret)):
+    for i, row in enumerate(rows):
 
         output = ''
         for tag in query:
-            value = str(ret[i].GetDataElement(TAGS_GDCM(tag)).GetValue())
+            value = row[tag]
             results[tag].append(value)
             if tag in verbose:
                 output = '%s | %s' % (output, value)
@@ -171,6 +412,14 @@ def perform_sort(root=None):
         d = dicom.read_file(dcm)
 
 def perform_move(configs, query={}, verbose=False):
+    """
+    Method to perform a C-MOVE of query to configs['aet_calling']
+
+    :return
+
+      (bool) result : True if the PACS reported the move as successful
+
+    """
 
     # --- Configure query
     ds = gdcm.DataSet()
@@ -187,6 +436,8 @@ def perform_move(configs, query={}, verbose=False):
             configs['aet_calling'], configs['aet_called'], configs['destination'])
     if verbose: print('Operation complete')
 
+    return result
+
 # =========================================================================
 # TEST SERVERS | CONFIGURATIONS
 # =========================================================================
@@ -218,6 +469,20 @@ query_uk = {
 # perform_find(configs_uk, query_uk)
 # perform_move(configs_uk, query_uk)
 
+# --- stand-in SCP on this machine for testing sessions, e.g. 
+#     dcmqrscp or pynetdicom's qrscp listening on port 11112
+configs_local = {
+    'ip': '127.0.0.1',
+    'port_called': 11112,
+    'port_calling': 11113,
+    'aet_called': 'LOCAL_SCP',
+    'aet_calling': 'LOCAL_SCU',
+    'destination': '/tmp/dicom/raw'
+}
+
+# session = SessionPool(configs_local)
+# perform_find(configs_local, query_uk, verbose=['studyUID'], session=session)
+
 # =========================================================================
 # UCI SERVERS | CONFIGURATIONS
 # =========================================================================
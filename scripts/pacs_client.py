@@ -3,16 +3,101 @@
 # https://github.com/peterchang77/
 # ------------------------------------------------------------------
 
-import os, glob, shutil, pydicom, pandas as pd, pickle
+import os, glob, shutil, pydicom, pandas as pd, pickle, multiprocessing, multiprocessing.util, time, csv
 import pacs
 
+# --- columns of the csvs/move_status_[suffix].csv table
+MOVE_STATUS = ['studyUID', 'mrn', 'accession', 'status', 'attempts', 'instances', 'seconds']
+
+# --- C-FIND context of each worker process (set by set_session)
+CONFIGS = None
+SESSION = None
+CACHE = None
+
+def set_session(configs, cache=None):
+    """
+    Method to give the current process its own C-FIND session (used as process pool initializer)
+
+    The association is released when the worker exits, i.e. after pool.close(); pool.join()
+    (pool.terminate() kills the workers without releasing it)
+
+    """
+    global CONFIGS, SESSION, CACHE
+    CONFIGS = configs
+    SESSION = pacs.FindSession(configs)
+    CACHE = cache
+
+    multiprocessing.util.Finalize(SESSION, SESSION.close, exitpriority=10)
+
+def find_query(query):
+    """
+    Method to perform a single C-FIND in a worker process
+
+    Note that perform_find() may add default tags to query, so the query is returned as well
+
+    """
+    results = pacs.perform_find(configs=CONFIGS, query=query, results={'mrn': []}, session=SESSION, cache=CACHE)
+
+    return query, results
+
+def move_study(job):
+    """
+    Method to C-MOVE a single study, retrying failed moves with exponential backoff
+
+    Note that gdcm only reports success or failure of a C-MOVE (no sub-operation
+    counts), so the number of instances received is counted in the study folder
+
+    :params
+
+      (tuple) job : (configs, root, studyUID, mrn, accession, retries, backoff)
+
+    :return
+
+      (dict) status row (see MOVE_STATUS); status is 'completed', 'warning' 
+        (successful move but no instances received) or 'failed'
+
+    """
+    configs, root, studyUID, mrn, acc, retries, backoff = job
+    start = time.time()
+
+    for attempt in range(retries + 1):
+
+        if attempt > 0:
+            time.sleep(backoff * 2 ** (attempt - 1))
+
+        try:
+            result = pacs.perform_move(configs=configs, query={'studyUID': studyUID})
+        except:
+            result = False
+
+        if result:
+            break
+
+    instances = len(glob.glob('%s/%s/%s/**/*.dcm' % (root, mrn, acc), recursive=True))
+
+    if not result:
+        status = 'failed'
+    elif instances == 0:
+        status = 'warning'
+    else:
+        status = 'completed'
+
+    return {
+        'studyUID': studyUID,
+        'mrn': mrn,
+        'accession': acc,
+        'status': status,
+        'attempts': attempt + 1,
+        'instances': instances,
+        'seconds': round(time.time() - start, 1)}
+
 class Client():
 
     def __init__(self, root, configs='vm1'):
 
         self.root = root
 
-        assert configs in ['exx', 'mac', 'fs1', 'vm1', 'vis']
+        assert configs in ['exx', 'mac', 'fs1', 'vm1', 'vis', 'local']
 
         if configs == 'exx':
             self.configs = pacs.configs_exx
@@ -29,7 +114,10 @@ class Client():
         if configs == 'vis':
             self.configs = pacs.configs_vis
 
-    def perform_find(self, suffix=''):
+        if configs == 'local':
+            self.configs = pacs.configs_local
+
+    def perform_find(self, suffix='', concurrency=1, cache=None):
         """
         Method to perform a series of C-FIND based on input *.csv files and 
         save results into various output *.csv files:
@@ -44,22 +132,71 @@ class Client():
         :params
 
           (str) suffix : suffix to [root]/csvs/query_[suffix].csv query file 
+          (int) concurrency : number of C-FIND queries in flight (keep within the PACS association limit); 
+            each runs in its own process with its own association and results are kept in query order
+          (obj) cache : if provided, a pacs.FindCache used to skip queries answered by a previous run
 
         """
-        results = {'mrn': []}
         missing = dict([(k, []) for k in pacs.TAGS_SORTED]) 
         csv_file = '%s/csvs/query_%s.csv' % (self.root, suffix)
         queries = self.parse_csv(csv_file)
         indices = []
 
+        # --- create every column up front so requests without any match still write empty csvs
+        results = dict([(k, []) for k in pacs.TAGS_SORTED])
+        for query in queries:
+            for tag in query:
+                results.setdefault(tag, [])
+
+        # --- plan C-FIND queries (each covering one or more query rows)
+        planned, groups = self.plan_queries(queries)
+        planned_results = []
+
+        if concurrency > 1:
+
+            # --- processes rather than threads, gdcm holds the GIL during C-FIND
+            with multiprocessing.Pool(processes=concurrency, initializer=set_session, initargs=(self.configs, cache)) as pool:
+                for n, (query, query_results) in enumerate(pool.imap(find_query, planned)):
+
+                    print('Perform C-FIND %04i / %04i' % (n + 1, len(planned)), end='\r')
+                    planned[n] = query
+                    planned_results.append(query_results)
+
+                # --- let workers exit normally so their associations are released
+                pool.close()
+                pool.join()
+
+        else:
+
+            # --- reuse open associations across queries
+            session = pacs.SessionPool(self.configs, size=1)
+
+            for n, query in enumerate(planned):
+
+                print('Perform C-FIND %04i / %04i' % (n + 1, len(planned)), end='\r')
+                query_results = pacs.perform_find(configs=self.configs, query=query, results={'mrn': []}, session=session, cache=cache)
+                planned_results.append(query_results)
+
+            session.close()
+
+        # --- split results back to query rows
+        rows = [[] for _ in queries]
+        for query, group, query_results in zip(planned, groups, planned_results):
+            for n, i in self.assign_results(queries, group, query_results):
+                rows[n].append((query_results, i))
+
+        # --- reassemble results in query row order
         for n, query in enumerate(queries):
 
-            print('Perform C-FIND %04i / %04i' % (n + 1, len(queries)), end='\r')
-            results_len = len(results['mrn'])
-            results = pacs.perform_find(configs=self.configs, query=query, results=results)
-            results_N = len(results['mrn']) - results_len 
-            indices += [n] * results_N
-            if results_N == 0:
+            if 'studyUID' not in query:
+                query['studyUID'] = '*'
+
+            for query_results, i in rows[n]:
+                for tag, values in query_results.items():
+                    results.setdefault(tag, []).append(values[i])
+
+            indices += [n] * len(rows[n])
+            if len(rows[n]) == 0:
                 for tag, value in query.items():
                     missing[tag].append(value)
 
@@ -73,6 +210,38 @@ class Client():
 
         print('A total of %i studies found based on %i queries' % (len(matches['mrn']), len(queries)))
 
+    def plan_queries(self, queries):
+        """
+        Method to plan the C-FIND queries performed for the query rows
+
+        Note that this method may be overloaded to merge several rows into one 
+        C-FIND, in which case assign_results() should be overloaded as well
+
+        :return
+
+          (list) planned : queries to perform
+          (list) groups : for each planned query, the list of query row indices it covers
+
+        """
+        return list(queries), [[n] for n in range(len(queries))]
+
+    def assign_results(self, queries, group, results):
+        """
+        Method to assign the results of one planned query to query rows
+
+        :params
+
+          (list) queries : all query rows
+          (list) group : indices of the query rows covered by the planned query
+          (dict) results : results of the planned query
+
+        :return
+
+          (list) of (row index, result index); a result may be assigned to several rows
+
+        """
+        return [(n, i) for n in group for i in range(len(results['studyUID']))]
+
     def write_csv(self, data, columns, csv_name):
 
         df = pd.DataFrame(data)
@@ -155,15 +324,28 @@ class Client():
         print('Total of %i DICOM objects did not contain required headers' % len(errors))
         pickle.dump(errors, open('%s/raw/errors.pickle' % self.root, 'wb'))
 
-    def perform_move(self, root=None, suffix='', overwrite=False, slices=None):
+    def perform_move(self, root=None, suffix='', overwrite=False, slices=None, concurrency=1, retries=2, backoff=30, on_complete=None):
         """
         Method to perform a series of C-MOVE operations based on studies
         recorded in root/csvs/matches.csv file
 
+        The result of each study is written to root/csvs/move_status_[suffix].csv 
+        as soon as its C-MOVE finishes (see move_study())
+
         :params
 
           (str) root : location of sorted downloaded files; if None, will use the default self.configs['destination']
           (bool) overwrite : if False, will check for existence of output first before C-MOVE
+          (int) concurrency : number of C-MOVEs in flight (keep within the PACS limit); values > 1 require
+            the move destination to be a standalone storage SCP. pacs.perform_move (gdcm CMove) opens its
+            own C-STORE listener on configs['port_calling'] for each move, so concurrent moves fail to bind
+          (int) retries : number of times a failed C-MOVE is retried
+          (int) backoff : seconds before the first retry, doubled for each further retry
+          (func) on_complete : if provided, called with the status row of each study as soon as it finishes
+
+        :return
+
+          (list) status rows of all moved studies
 
         """
         matches = '%s/csvs/matches_%s.csv' % (self.root, suffix)
@@ -174,24 +356,48 @@ class Client():
         root = self.configs['destination'] if root is None else root
         df = pd.read_csv(matches)
 
-        # --- Create list of missing studyUIDs
-        if not overwrite:
-            studyUIDS = []
-            for studyUID, mrn, acc in zip(df['studyUID'], df['mrn'], df['accession']):
-                src = '%s/%s/%s' % (root, mrn, str(acc).strip())
-                if not os.path.exists(src):
-                    studyUIDS.append(studyUID)
-
-        else:
-            studyUIDS = df['studyUID']
+        # --- Create list of missing studies
+        studies = []
+        for studyUID, mrn, acc in zip(df['studyUID'], df['mrn'], df['accession']):
+            acc = str(acc).strip()
+            src = '%s/%s/%s' % (root, mrn, acc)
+            if overwrite or not os.path.exists(src):
+                studies.append((self.configs, root, studyUID, mrn, acc, retries, backoff))
 
         if slices is None:
-            slices = slice(0, len(studyUIDS) + 1)
+            slices = slice(0, len(studies) + 1)
+
+        jobs = studies[slices]
+
+        # --- Write status of each study as it finishes
+        status_file = open('%s/csvs/move_status_%s.csv' % (self.root, suffix), 'w', newline='')
+        writer = csv.DictWriter(status_file, fieldnames=MOVE_STATUS)
+        writer.writeheader()
+
+        statuses = []
+        pool = multiprocessing.Pool(processes=concurrency) if concurrency > 1 else None
+        moves = pool.imap_unordered(move_study, jobs) if pool is not None else map(move_study, jobs)
+
+        for n, status in enumerate(moves):
+
+            print('Perform C-MOVE %04i / %04i' % (n + 1, len(studies)), end='\r')
+            writer.writerow(status)
+            status_file.flush()
+            statuses.append(status)
+
+            if on_complete is not None:
+                on_complete(status)
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        status_file.close()
+
+        failed = len([s for s in statuses if s['status'] != 'completed'])
+        print('A total of %i studies moved, %i failed or empty (see move_status_%s.csv)' % (len(statuses) - failed, failed, suffix))
 
-        for n, studyUID in enumerate(studyUIDS[slices]):
-            print('Perform C-MOVE %04i / %04i' % (n + 1, len(studyUIDS)), end='\r')
-            pacs.perform_move(configs=self.configs, query={
-                'studyUID': studyUID})
+        return statuses
 
     def move_dicoms(self, root=None, suffix='', summary_only=False):
         """
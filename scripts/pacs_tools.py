@@ -13,6 +13,12 @@ import sys
 # --- sets which PACS server to download from
 CONFIGS='vis'
 
+# --- number of C-MOVEs in flight (keep within the PACS limit). pacs.perform_move receives
+#     each move with its own C-STORE listener on configs['port_calling'], so more than 1
+#     only works once the move destination is a standalone storage SCP (and perform_move
+#     no longer listens itself); otherwise the extra moves fail to bind and are retried
+CONCURRENCY = 1
+
 def count_lines(fname):
 
     with open(fname) as f:
@@ -21,8 +27,12 @@ def count_lines(fname):
 
     return i
 
-def main(root, mode='download'):
-
+def main(root, mode='download', on_complete=None):
+    """
+    Runs mode for the matches csv in root/csvs. In download mode, returns the
+    C-MOVE status rows of the moved studies (None if nothing was moved) and 
+    calls on_complete (if given) with each row as soon as its study finishes.
+    """
     # --- Find suffix
     matches_files = glob.glob(root + '/csvs/matches_*.csv')
 
@@ -42,7 +52,7 @@ def main(root, mode='download'):
 
             lines = count_lines(matches_files[0])
             if input('A total of %i exams to be downloaded, please confirm by typing this number: ' % lines) == str(lines):
-                client.perform_move(suffix=suffix)
+                return client.perform_move(suffix=suffix, concurrency=CONCURRENCY, on_complete=on_complete)
 
         # --- Count
         elif mode == 'count':
@@ -5,13 +5,39 @@
 #  USAGE: scrub_secondary.py <directiory_path> <yaml_path>
 # --------------------------------------------------
 import yaml
-import sys, os, glob
+import sys, os, glob, itertools
+import multiprocessing, queue
+import numpy as np
 import pydicom
 from pydicom.tag import Tag
+from journal import Journal, atomic_save
 
 # --- fields that contain lists
 list_fields = ['ImageType']
 modalities_to_scrub = set(['NM', 'PET', 'US', 'OT'])
+
+# --- header tags read to find secondary / derived candidates
+SCAN_TAGS = ['Modality', 'ImageType']
+
+# --- transfer syntax scrubbed pixels are re-encoded with (None keeps them uncompressed).
+#     pydicom 2.x Dataset.compress only encodes RLE Lossless '1.2.840.10008.1.2.5'
+OUTPUT_TRANSFER_SYNTAX = '1.2.840.10008.1.2.5'
+
+# --- fields used to bucket rules (a rule without the field matches any value)
+INDEX_FIELDS = ['Modality', 'Manufacturer', 'ManufacturerModelName', 'Rows', 'Columns']
+
+# --- header tags used to estimate decoded pixel size. a scrub holds about
+#     DECODE_COPIES copies of it (decoded PixelData, pixel array, re-encoded pixels)
+SIZE_TAGS = ['Rows', 'Columns', 'NumberOfFrames', 'SamplesPerPixel', 'BitsAllocated']
+DECODE_COPIES = 3
+
+# --- bytes of estimated pixel memory allowed in flight (None uses half of physical memory)
+MEMORY_BUDGET = None
+
+# --- scrub context of each worker process (set by set_rules)
+RULES = None
+JOURNAL = None
+TRANSFER_SYNTAX = OUTPUT_TRANSFER_SYNTAX
 # --------------------------------------------------
 #  main function
 # --------------------------------------------------
@@ -23,15 +49,44 @@ def anonymize_all(scrub_dict, rules):
 
             anonymize(path, rules)
 
-def anonymize(dir_path, rules):
+def anonymize(dir_path, rules, resume=False, journal_path=None, transfer_syntax=OUTPUT_TRANSFER_SYNTAX, workers=None, memory_budget=MEMORY_BUDGET, quarantine_path=None, log_path=None, rescan=False, shared_budget=None):
 
     """
     Traverses through the directory and scrubs all the dcms
     based on the rules provided in the yaml.
+
+    If resume is True, files finished by an interrupted run (recorded in 
+    journal_path, default <dir_path>/../logs/scrub_journal.txt) are skipped.
+    A completed scrub is not repeated (its files may have been moved to pid
+    folders since), unless rescan is True to pick up files added afterwards.
+
+    Scrubbed pixels are re-encoded with transfer_syntax (see OUTPUT_TRANSFER_SYNTAX).
+
+    Files are scrubbed by a pool of workers (default os.cpu_count()) while their
+    estimated decoded size in flight stays under memory_budget bytes. With
+    workers=1, shared_budget (a MemoryBudget) bounds the memory of all processes
+    scrubbing at the same time instead.
+
+    Secondaries that match no rule are moved to quarantine_path (default
+    <dir_path>/../quarantine) keeping their relative path, and logged in
+    log_path (default <dir_path>/../logs/scrub.txt).
     """
-    # --- traverse and perform secondary scrub on all dicoms
-    print('Scrubbing secondaries.')
-    count = 0
+    # --- open journal of finished files, finish interrupted writes
+    if journal_path is None:
+        journal_path = os.path.dirname(os.path.normpath(dir_path)) + '/logs/scrub_journal.txt'
+    journal = Journal(journal_path, resume=resume)
+    journal.recover(dir_path)
+
+    if journal.complete and not rescan:
+        print('Secondaries already scrubbed.')
+        return
+
+    # --- traverse and find secondaries with a cheap header scan, rules
+    #     are matched once per series for each distinct set of rule fields
+    print('Scanning for secondaries.')
+    candidates = []
+    errors = []
+    series_rules = {}
     for root, directories, file_paths in os.walk(dir_path):
         
         for file_path in file_paths:
@@ -39,140 +94,341 @@ def anonymize(dir_path, rules):
             # --- only scrub dcm files
             if file_path.endswith('.dcm'):
                 
-                # --- create full path and anonymize
+                # --- create full path and check header
                 full_path = root + '/' + file_path
-                dcm_bool = anonymize_dcm(full_path, rules)
-                count += 1
+                if full_path in journal:
+                    continue
+
+                try:
+                    dcm = read_scan_header(full_path, rules)
+                    if is_candidate(dcm):
+                        candidates.append((full_path, match_series(dcm, rules, series_rules), estimate_size(dcm)))
+                except Exception as e:
+                    errors.append((full_path, str(e)))
+
+    # --- quarantine unmatched candidates, matched ones are journaled when saved
+    if quarantine_path is None:
+        quarantine_path = os.path.dirname(os.path.normpath(dir_path)) + '/quarantine'
+
+    if log_path is None:
+        log_path = os.path.dirname(os.path.normpath(dir_path)) + '/logs/scrub.txt'
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    log_file = open(log_path, 'a' if resume else 'w')
+
+    # --- files whose header cannot be read are not checked for burnt in PHI
+    for full_path, message in errors:
+        log_file.write('ERRS: %s | pydicom cannot read header | %s\n' % (full_path, message))
+
+    if len(errors) > 0:
+        print('WARNING: ' + str(len(errors)) + ' files could not be read and were not checked (see ' + log_path + ').')
+
+    jobs = []
+    for full_path, rule, estimate in candidates:
+
+        if rule is None:
+            dst = quarantine_path + '/' + os.path.relpath(full_path, dir_path)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.rename(full_path, dst)
+            log_file.write('QUAR: %s | no scrub rule matched\n' % full_path)
+            journal.add(full_path)
+        else:
+            jobs.append((full_path, rule, estimate))
+
+    log_file.close()
+    print('Quarantined ' + str(len(candidates) - len(jobs)) + ' unmatched secondaries.')
+
+    # --- perform secondary scrub on matched candidates only
+    print('Scrubbing ' + str(len(jobs)) + ' of ' + str(len(candidates)) + ' secondaries.')
+    count = scrub_all(jobs, rules, journal, transfer_syntax, workers, memory_budget, shared_budget)
+
+    journal.finish()
     print('Scrubbed ' + str(count) + ' secondaries.')
+
+def scrub_all(jobs, rules, journal=None, transfer_syntax=OUTPUT_TRANSFER_SYNTAX, workers=None, memory_budget=MEMORY_BUDGET, shared_budget=None):
+    """
+    Scrubs jobs in a process pool. A job is only started while the estimated
+    memory of all running jobs stays under memory_budget, a job larger than the
+    budget runs once nothing else is running.
+
+    Parameters:
+    jobs - list of (dcm_path, rule, estimated bytes)
+    rules - RuleIndex the rules of jobs belong to
+    shared_budget - MemoryBudget shared with other processes scrubbing in this process (workers=1)
+    
+    Returns:
+    count - number of scrubbed files
+    """
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    memory_budget = default_memory_budget() if memory_budget is None else memory_budget
+
+    # --- finished jobs report (estimate, error) back to the scheduler
+    finished = queue.Queue()
+
+    def wait():
+        estimate, error = finished.get()
+        if error is not None:
+            raise error
+        return estimate
+
+    # --- scrub in this process (e.g. when already running in a worker)
+    if workers == 1:
+        for count, (full_path, rule, estimate) in enumerate(jobs):
+
+            if shared_budget is not None:
+                shared_budget.acquire(estimate)
+            try:
+                scrub_dcm(pydicom.dcmread(full_path), full_path, rule, journal, transfer_syntax)
+            finally:
+                if shared_budget is not None:
+                    shared_budget.release(estimate)
+
+            print('Scrubbed ' + str(count + 1) + '/' + str(len(jobs)), end='\r')
+
+        return len(jobs)
+
+    # --- workers reopen the journal file themselves
+    if journal is not None:
+        journal.close()
+
+    count = 0
+    running = 0
+    in_flight = 0
+    with multiprocessing.Pool(processes=workers, initializer=set_rules, initargs=(rules, journal, transfer_syntax)) as pool:
+        for full_path, rule, estimate in jobs:
+
+            # --- wait for a free worker and enough memory
+            while running and (running >= workers or in_flight + estimate > memory_budget):
+                in_flight -= wait()
+                running -= 1
+                count += 1
+                print('Scrubbed ' + str(count) + '/' + str(len(jobs)), end='\r')
+
+            pool.apply_async(scrub_file, (full_path, rule.position),
+                             callback=lambda _, estimate=estimate : finished.put((estimate, None)),
+                             error_callback=lambda error, estimate=estimate : finished.put((estimate, error)))
+            running += 1
+            in_flight += estimate
+
+        # --- wait for remaining jobs
+        while running:
+            in_flight -= wait()
+            running -= 1
+            count += 1
+            print('Scrubbed ' + str(count) + '/' + str(len(jobs)), end='\r')
+
+    return count
+
+def set_rules(rules, journal=None, transfer_syntax=OUTPUT_TRANSFER_SYNTAX):
+    """
+    Sets the scrub context of the current process (used as process pool initializer).
+    """
+    global RULES, JOURNAL, TRANSFER_SYNTAX
+    RULES = rules
+    JOURNAL = journal
+    TRANSFER_SYNTAX = transfer_syntax
+
+def scrub_file(dcm_path, position):
+    """
+    Scrubs a single dcm with the rule at position in RULES (worker process).
+    """
+    scrub_dcm(pydicom.dcmread(dcm_path), dcm_path, RULES.rules[position], JOURNAL, TRANSFER_SYNTAX)
+
+    return dcm_path
+
+def estimate_size(dcm):
+    """
+    Estimates bytes of memory needed to scrub dcm from its header
+    (Rows x Columns x Frames x SamplesPerPixel x BitsAllocated).
+    """
+    rows = int(dcm.get('Rows', 0) or 0)
+    cols = int(dcm.get('Columns', 0) or 0)
+    frames = int(dcm.get('NumberOfFrames', 1) or 1)
+    samples = int(dcm.get('SamplesPerPixel', 1) or 1)
+    bits = int(dcm.get('BitsAllocated', 16) or 16)
+
+    return rows * cols * frames * samples * bits // 8 * DECODE_COPIES
+
+def default_memory_budget():
+    """
+    Returns half of the physical memory in bytes (4 GB if unknown).
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+    except:
+        return 4 * 1024 ** 3
+
+class MemoryBudget():
+    """
+    Estimated pixel memory in flight, shared by processes that each scrub their
+    own files (e.g. the workers of stream_pipeline). Must be passed to the
+    processes when they are created (e.g. as process pool initializer argument).
+    """
+    def __init__(self, budget=MEMORY_BUDGET):
+
+        self.budget = default_memory_budget() if budget is None else budget
+        self.in_flight = multiprocessing.Value('q', 0)
+        self.condition = multiprocessing.Condition(self.in_flight.get_lock())
+
+    def acquire(self, estimate):
+        """
+        Waits until estimate fits the budget, a job larger than the budget
+        runs once nothing else is running.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda : self.in_flight.value == 0 or self.in_flight.value + estimate <= self.budget)
+            self.in_flight.value += estimate
+
+    def release(self, estimate):
+
+        with self.condition:
+            self.in_flight.value -= estimate
+            self.condition.notify_all()
 # -----------------------------------------------------------
 #  dicom checking and processing functions
 # -----------------------------------------------------------
-def anonymize_dcm(dcm_path, rules):
+def scrub_dcm(dcm, dcm_path, rule, journal=None, transfer_syntax=OUTPUT_TRANSFER_SYNTAX):
     """
-    Anonymizes a single dcm using the processed rules from
-    the YAML file provided.
+    Removes the coordinates of a matched rule from the pixels of dcm
+    and replaces dcm_path atomically. Pixels are re-encoded with
+    transfer_syntax, or left uncompressed if it is None or no encoder
+    is available.
     """
-    # --- load dcm metadata 
-    dcm = pydicom.dcmread(dcm_path, stop_before_pixels=True)
-    
-    # --- load stratified rules by modality and combine it with general rules
-    dcm_modality = dcm['Modality'].value
-    if 'ImageType' in dcm:
-        dcm_image_type = dcm['ImageType'].value
-    else:
-        dcm_image_type = ''
+    # --- decompress dicom and read pixel array
+    dcm.decompress()
+    dcm_array = dcm.pixel_array
 
-#    if 'SECONDARY' in str(dcm_image_type):
-    if 'SECONDARY' in str(dcm_image_type) or 'DERIVED' in str(dcm_image_type):
-        if dcm_modality in rules.keys():
-            rules = rules[dcm_modality] + rules['OTHER']
-        else:
-            rules = rules['OTHER']
-        
-        # --- check and anonymize by looping through rules
-        for rule in rules:
+    # --- remove specific pixels
+    dcm_array.setflags(write=1)
+    
+    if dcm['Modality'].value == 'US':
+        if pydicom.pixel_data_handlers.numpy_handler.should_change_PhotometricInterpretation_to_RGB(dcm_array):
+            dcm_array = pydicom.pixel_data_handlers.util.convert_color_space(dcm_array, 'YBR_FULL', 'RGB')
+            dcm.PhotometricInterpretation = 'RGB'
 
-            # --- check for a complete match in all fields in the rule
-            match = verify_rule(dcm, rule)
-            
-            # --- if rule match then scrub
-            if match == True:
+    # --- remove all coordinates in every frame and channel at once
+    scrub_array(dcm_array, rule, int(getattr(dcm, 'NumberOfFrames', 1) or 1))
 
-                # --- get coordinates
-                coords = rule['coords']
+    dcm_array.setflags(write=0)
 
-                # --- get pixel data
-                dcm = pydicom.dcmread(dcm_path)
-                
-                # --- decompress dicom and read pixel array
-                dcm.decompress()
-                dcm_array = dcm.pixel_array
+    # --- re-encode so scrubbed files stay close to their original size
+    encoded = False
+    if transfer_syntax:
+        try:
+            dcm.compress(transfer_syntax, dcm_array)
+            encoded = True
+        except:
+            print('Could not encode ' + str(transfer_syntax) + ', saving uncompressed: ' + dcm_path)
 
-                # --- remove specific pixels
-                dcm_array.setflags(write=1)
-                
-                if dcm_modality == 'US':
-                    if pydicom.pixel_data_handlers.numpy_handler.should_change_PhotometricInterpretation_to_RGB(dcm_array):
-                        dcm_array = pydicom.pixel_data_handlers.util.convert_color_space(dcm_array, 'YBR_FULL', 'RGB')
-                        dcm.PhotometricInterpretation = 'RGB'
+    if not encoded:
+        dcm.PixelData = dcm_array.tobytes()
+        dcm.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
 
-                if len(dcm_array.shape) == 4:
-                    
-                    # --- remove different spots for each coordinate
-                    for coord in coords:
-                        dcm_array[:, coord['y0'] : coord['y1'], coord['x0'] : coord['x1']] = 0
-                    
-                elif (len(dcm_array.shape) == 2) or (len(dcm_array.shape) == 3):
+    # --- save files
+    atomic_save(dcm, dcm_path, journal)
 
-                    for coord in coords:
-                        dcm_array[coord['y0'] : coord['y1'], coord['x0'] : coord['x1']] = 0
+def match_series(dcm, rules, series_rules):
+    """
+    Matches a scan header against the rules, reusing the rule found for
+    earlier files of the same series with identical rule fields. Files
+    that deviate within a series (e.g. different Rows / Columns) are
+    matched on their own.
 
-                dcm_array.setflags(write=0)
+    Parameters:
+    dcm - header read with read_scan_header(dcm_path, rules)
+    rules - RuleIndex from prepare_yaml
+    series_rules - dictionary of SeriesInstanceUID -> {signature : rule}, updated in place
 
-                # --- save files
-                dcm.PixelData = dcm_array.tostring()
-                dcm.save_as(dcm_path)
+    Returns:
+    rule - matched Rule or None
+    """
+    series_uid = dcm.get('SeriesInstanceUID', None)
+    signature = rules.signature(dcm)
 
-                # --- assume only one rule will be matched, return False to not quarantine
-                return False
+    cache = series_rules.setdefault(series_uid, {})
+    if signature not in cache:
+        cache[signature] = rules.match(dcm)
 
-        # ---- no rules found so remove to quarantine
-        return True
-    
-    return False
+    return cache[signature]
             
+def read_scan_header(dcm_path, rules=None):
+    """
+    Reads only the header tags needed to find secondary / derived candidates
+    and, if rules are given, to match them.
+    """
+    tags = SCAN_TAGS if rules is None else rules.scan_tags
+
+    return pydicom.dcmread(dcm_path, stop_before_pixels=True, specific_tags=tags)
+
+def is_candidate(dcm):
+    """
+    Checks if dcm is a secondary / derived image (the only images that are scrubbed).
+    """
+    if 'Modality' not in dcm:
+        return False
+
+    if 'ImageType' in dcm:
+        dcm_image_type = dcm['ImageType'].value
+    else:
+        dcm_image_type = ''
+
+    return 'SECONDARY' in str(dcm_image_type) or 'DERIVED' in str(dcm_image_type)
+
 def verify_rule(dcm, rule):
     """
     Checks the dcm file against the fields given for a single rule.
     
     Parameters:
     dcm - dcm metadata obtained from dcmread(dicom_path)
-    rule - dictionary containing specific fields the rule is looking for
+    rule - compiled Rule containing specific fields the rule is looking for
     
     Returns:
     match - boolean signifying if there is a rule match
     """
-    
-    # --- extract all fields in a rule
-    fields = rule['fields']
-    
-    for field, desc in fields.items():
-        
-        # --- check if field is a tag, if so convert it to a friendly format
-        if isTag(field):
-            field = format_tag(field)
+    for field, is_list, field_desc in rule.fields:
 
         # --- check if theres a match
         if field in dcm:
             
             # --- check if field normally contains a list (e.g. ImageType)
-            if field in list_fields: # --- see global variable at top
+            if is_list:
                 
                 # --- process descriptions into a list and remove spaces in each value
-                dcm_list = list(dcm[field].value)
-                dcm_list = list(map(lambda x : x.replace(' ', ''), dcm_list))
-                
-                # --- remove possible spaces in field
-                field_desc = desc.replace(' ', '')
+                dcm_value = dcm[field].value
+                dcm_list = [dcm_value] if isinstance(dcm_value, str) else list(dcm_value)
+                dcm_list = list(map(lambda x : str(x).replace(' ', ''), dcm_list))
                 
                 # --- check if field is present within list
                 if field_desc not in dcm_list:
                     return False
             else: 
-                # --- process descriptions. capitalize and remove spaces
-                field_desc = str(desc.upper())
-                field_desc = field_desc.replace(' ', '')
-
-                dcm_desc = str(dcm[field].value).upper()
-                dcm_desc = dcm_desc.replace(' ', '')
-
-                if field_desc != dcm_desc:
+                # --- compare against capitalized description without spaces
+                if field_desc != normalize(dcm[field].value):
                     return False
 
         else:
             return False
     
     return True
+
+def scrub_array(dcm_array, rule, frames=1):
+    """
+    Zeroes the coordinates of a rule in place. dcm_array is shaped
+    (rows, cols), (rows, cols, samples), (frames, rows, cols) or
+    (frames, rows, cols, samples).
+    """
+    # --- frames lead the row / column axes, samples follow them
+    if frames > 1:
+        mask = rule.mask(*dcm_array.shape[1:3])
+        dcm_array[:, mask] = 0
+    else:
+        mask = rule.mask(*dcm_array.shape[0:2])
+        dcm_array[mask] = 0
+
+def normalize(value):
+    """
+    Capitalizes and removes spaces from a value for comparison.
+    """
+    return str(value).upper().replace(' ', '')
 # -----------------------------------------------------------
 #  Tag checking and manipulation functions (ex: (0008, 0010))
 # -----------------------------------------------------------
@@ -204,36 +460,125 @@ def format_tag(tag):
     
     return tag
 # --------------------------------------------------
-#  load and stratify yaml rules
+#  load and compile yaml rules
 # --------------------------------------------------
-def prepare_yaml(yaml_path):
+class Rule():
     """
-    Loads the yaml file and stratifies it by modality. If it 
-    is modality agnostic, then it is placed into 'OTHER'.
+    A yaml rule with tags pre-parsed and descriptions pre-normalized.
     """
-    # --- load rules
-    rules = yaml.load(open(yaml_path, 'r'), Loader=yaml.FullLoader)
-    
-    # --- Sort rules by modality
-    rules_stratified = {'OTHER' : []}
-    for rule in rules:
 
-        fields = rule['fields']
+    def __init__(self, rule, priority):
 
-        if 'Modality' in fields.keys():
+        self.coords = rule['coords']
+        self.priority = priority
+        self.masks = {}
 
-            if fields['Modality'] not in rules_stratified.keys():
+        # --- compile fields into (field or tag, is list field, normalized description)
+        self.fields = []
+        for field, desc in rule['fields'].items():
 
-                # --- if modality isn't present, add it
-                rules_stratified[fields['Modality']] = [rule]
+            # --- check if field is a tag, if so convert it to a friendly format
+            if isTag(field):
+                field = format_tag(field)
+
+            if field in list_fields: # --- see global variable at top
+                self.fields.append((field, True, str(desc).replace(' ', '')))
             else:
-                rules_stratified[fields['Modality']].append(rule)
+                self.fields.append((field, False, normalize(desc)))
 
-        # --- otherwise add to other
-        else:
-            rules_stratified['OTHER'].append(rule)
+        # --- bucket key, None for fields not in the rule
+        fields = rule['fields']
+        self.key = tuple([normalize(fields[f]) if f in fields else None for f in INDEX_FIELDS])
+
+    def mask(self, rows, cols):
+        """
+        Returns the boolean (rows, cols) mask of all coordinates, built
+        once per geometry.
+        """
+        if (rows, cols) not in self.masks:
+            mask = np.zeros((rows, cols), dtype=bool)
+            for coord in self.coords:
+                mask[coord['y0'] : coord['y1'], coord['x0'] : coord['x1']] = True
+            self.masks[(rows, cols)] = mask
+
+        return self.masks[(rows, cols)]
+
+class RuleIndex():
+    """
+    Rules bucketed by INDEX_FIELDS so a dcm is only verified against
+    the rules that could match it.
+
+    Rules are tried in the original order: rules of the dcm modality
+    first, then modality agnostic rules, each in yaml order.
+    """
+
+    def __init__(self, rules):
+
+        self.rules = []
+        self.buckets = {}
+        for n, rule in enumerate(rules):
+
+            # --- modality specific rules first
+            priority = (0 if 'Modality' in rule['fields'] else 1, n)
+
+            rule = Rule(rule, priority)
+            rule.position = n
+            self.rules.append(rule)
+            self.buckets.setdefault(rule.key, []).append(rule)
+
+        # --- every field that can affect a match
+        self.match_tags = list(INDEX_FIELDS)
+        for rule in self.rules:
+            for field, _, _ in rule.fields:
+                if field not in self.match_tags:
+                    self.match_tags.append(field)
+
+        # --- header tags needed to find candidates and match them
+        self.scan_tags = SCAN_TAGS + ['SeriesInstanceUID']
+        for t in self.match_tags + SIZE_TAGS:
+            if t not in self.scan_tags:
+                self.scan_tags.append(t)
+
+    def signature(self, dcm):
+        """
+        Returns the values of all match tags. Headers with the same
+        signature always match the same rule.
+        """
+        return tuple([str(dcm[t].value) if t in dcm else None for t in self.match_tags])
+
+    def candidates(self, dcm):
+        """
+        Returns rules that could match dcm sorted by priority.
+        """
+        values = [normalize(dcm[f].value) if f in dcm else None for f in INDEX_FIELDS]
+
+        # --- each field matches rules with the same value or without the field
+        keys = itertools.product(*[(v, None) if v is not None else (None,) for v in values])
+
+        rules = []
+        for key in keys:
+            rules += self.buckets.get(key, [])
+
+        return sorted(rules, key=lambda rule : rule.priority)
+
+    def match(self, dcm):
+        """
+        Returns the first rule with a complete match or None.
+        """
+        for rule in self.candidates(dcm):
+            if verify_rule(dcm, rule):
+                return rule
+
+        return None
+
+def prepare_yaml(yaml_path):
+    """
+    Loads the yaml file and compiles it into a RuleIndex.
+    """
+    # --- load rules
+    rules = yaml.load(open(yaml_path, 'r'), Loader=yaml.FullLoader)
     
-    return rules_stratified
+    return RuleIndex(rules)
 
 if __name__ == '__main__':
     
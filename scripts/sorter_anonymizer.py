@@ -9,10 +9,47 @@
 # https://github.com/chanonchantad/
 # =========================================================================================
 
-import glob, os, shutil
+import glob, os, shutil, json, struct
 import sys
+import multiprocessing
 import pydicom
 
+# --- header tags needed to sort and quarantine a DICOM without loading its pixels
+HEADER_TAGS = [
+    'AccessionNumber', 'SeriesInstanceUID', 'SOPInstanceUID', 'SOPClassUID',
+    'Modality', 'ImageType', 'BurnedAnnotation', 'SeriesDescription',
+    'Rows', 'Columns', 'SamplesPerPixel', 'PhotometricInterpretation', 'PlanarConfiguration',
+    'NumberOfFrames', 'BitsAllocated', 'BitsStored', 'HighBit', 'PixelRepresentation']
+
+# --- pixel data tags (PixelData, FloatPixelData, DoubleFloatPixelData), headers required to decode
+#     pixels and photometric interpretations by samples per pixel
+PIXEL_TAGS = [0x7fe00010, 0x7fe00008, 0x7fe00009]
+PIXEL_REQUIRED = ['Rows', 'Columns', 'BitsAllocated', 'SamplesPerPixel', 'PhotometricInterpretation']
+PHOTOMETRIC_SAMPLES = {
+    'MONOCHROME1': 1,
+    'MONOCHROME2': 1,
+    'PALETTE COLOR': 1,
+    'RGB': 3,
+    'HSV': 3,
+    'YBR_FULL': 3,
+    'YBR_FULL_422': 3,
+    'YBR_PARTIAL_422': 3,
+    'YBR_PARTIAL_420': 3,
+    'YBR_ICT': 3,
+    'YBR_RCT': 3,
+    'ARGB': 4,
+    'CMYK': 4}
+
+# --- accession --> seriesUID --> number of instances (see build_series_index)
+SERIES_INDEX = {}
+SERIES_INDEX_NAME = 'series_index.json'
+
+# --- series with this many instances or fewer are quarantined by the small_series rule
+SMALL_SERIES = 10
+
+# --- rules that need the complete series index and are applied after all headers are read
+DEFERRED_RULES = ['small_series']
+
 # =========================================================================================
 # Removes MRNs and sorts dicoms into accessions 
 # =========================================================================================
@@ -26,27 +63,54 @@ def sort_dcms(root):
     """
     sort_root = root + '/flat'
     dcms = glob.glob('%s/**/*.dcm' % sort_root, recursive=True)
+    paths = []
     for n, dcm in enumerate(dcms):
         try:
             path = create_path(dcm)
             move_file(src=dcm, dst=path, root=root)
+            paths.append(path.split('/'))
             print('%07i/%07i: Sorting DICOMs' % (n + 1, len(dcms)), end='\r')
         except:
             pass
 
-    print('%07i: DICOMs finished sorting' % n)
+    print('%07i: DICOMs finished sorting' % len(dcms))
+
+    # --- save number of instances per series
+    write_series_index(build_series_index(paths), root=root)
 
     return dcms
 
 def create_path(dcm):
 
-    d = pydicom.read_file(dcm)
+    d = read_header(dcm)
     
     return '%s/%s/%s.dcm' % (
         d.AccessionNumber,
         d.SeriesInstanceUID,
         d.SOPInstanceUID)
 
+def read_header(dcm):
+    """
+    Method to read only the DICOM headers required for sorting and quarantine
+
+    Reading stops before the pixel data, which is never read from disk (not even
+    for compressed files). Its presence is stored in has_pixel_data and checked
+    from the tag at the position where reading stopped
+
+    """
+    with open(dcm, 'rb') as fp:
+        d = pydicom.dcmread(fp, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+
+        # --- pydicom leaves the file at the start of the pixel data element (or at its end)
+        tag = fp.read(4)
+        if len(tag) == 4:
+            group, element = struct.unpack(('<' if d.is_little_endian else '>') + 'HH', tag)
+            d.has_pixel_data = (group << 16 | element) in PIXEL_TAGS
+        else:
+            d.has_pixel_data = False
+
+    return d
+
 def move_file(src, dst, root):
     
     move_root = root + '/sorted'
@@ -58,6 +122,59 @@ def move_file(src, dst, root):
     # Move 
     shutil.move(src=src, dst='%s/%s' % (move_root, dst))
 
+def build_series_index(paths):
+    """
+    Method to count unique instances per series from (accession, seriesUID, instance) triplets
+
+    Returns { accession: { seriesUID: count } }
+
+    """
+    instances = {}
+    for acc, series, sop in paths:
+        instances.setdefault(acc, {}).setdefault(series, set()).add(sop)
+
+    return {acc: {series: len(sops) for series, sops in s.items()} for acc, s in instances.items()}
+
+def write_series_index(index, root):
+    """
+    Method to save series index to root/sorted/series_index.json for later stages
+
+    """
+    os.makedirs('%s/sorted' % root, exist_ok=True)
+    with open('%s/sorted/%s' % (root, SERIES_INDEX_NAME), 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+
+def load_series_index(root):
+    """
+    Method to load root/sorted/series_index.json
+
+    If the index does not exist, it is rebuilt by listing each sorted series folder once
+
+    """
+    path = '%s/sorted/%s' % (root, SERIES_INDEX_NAME)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    index = {}
+    for series in glob.glob('%s/sorted/*/*/' % root):
+        acc, series = series.split('/')[-3:-1]
+        index.setdefault(acc, {})[series] = len(glob.glob('%s/sorted/%s/%s/*.dcm' % (root, acc, series)))
+
+    return index
+
+def set_series_index(index):
+    """
+    Method to set the global SERIES_INDEX (used as process pool initializer)
+
+    """
+    global SERIES_INDEX
+    SERIES_INDEX = index
+
+def count_series(acc, series):
+
+    return SERIES_INDEX.get(acc, {}).get(series, 0)
+
 def summarize(root='/data/dicom/mirc_sorted'):
     """
     DEPRECATED FUNCTION
@@ -71,21 +188,74 @@ def summarize(root='/data/dicom/mirc_sorted'):
 # Checks to see which dicom files to keep/quarantine
 # ========================================================================
 
-def check_small_series(dcm, path, N=10):
+def check_small_series(dcm, path, N=SMALL_SERIES):
     """
     Method to check if DICOM has less than N number of images in series
 
+    Number of images is looked up in SERIES_INDEX
+
+    """
+    return count_series(dcm.AccessionNumber, dcm.SeriesInstanceUID) <= N
+
+def has_pixels(dcm):
+    """
+    Method to check if DICOM has a pixel data element (without reading it)
+
     """
-    dcms = glob.glob('%s/*.dcm' % os.path.dirname(path))
+    if hasattr(dcm, 'has_pixel_data'):
+        return dcm.has_pixel_data
 
-    return len(dcms) <= N
+    return any(tag in dcm for tag in PIXEL_TAGS)
+
+def read_pixels(dcm):
+    """
+    Method to decode the pixels of a DICOM read by read_header (reads the complete file)
+
+    Returns None if pixels cannot be decoded
+
+    """
+    try:
+        return pydicom.dcmread(dcm.filename).pixel_array
+    except:
+        return None
+
+def infer_ndim(dcm):
+    """
+    Method to infer pixel_array.ndim from the header without decoding pixels
+
+      * frame axis is present if NumberOfFrames > 1
+      * sample axis is present if SamplesPerPixel > 1 (or implied by PhotometricInterpretation)
+
+    Returns None if the header is ambiguous
+
+    """
+    try:
+        if 'SamplesPerPixel' in dcm:
+            samples = int(dcm.SamplesPerPixel)
+        else:
+            samples = PHOTOMETRIC_SAMPLES[str(dcm.PhotometricInterpretation).strip().upper()]
+
+        frames = int(dcm.NumberOfFrames) if 'NumberOfFrames' in dcm else 1
+
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+    return 2 + int(frames > 1) + int(samples > 1)
 
 def check_no_pixel_array(dcm, path):
     """
     Method to check if DICOM as no pixels
 
+    Pixels are only decoded if the header is incomplete
+
     """
-    return hasattr(dcm, 'pixel_array') == False
+    if not has_pixels(dcm):
+        return True
+
+    if all(tag in dcm for tag in PIXEL_REQUIRED):
+        return False
+
+    return read_pixels(dcm) is None
 
 def check_secondary_capture(dcm, path):
     """
@@ -116,12 +286,20 @@ def check_rgb(dcm, path):
     """
     Method to check if DICOM is RGB file
 
+    Pixels are only decoded if the header is ambiguous
+
     """
-    status = False
-    if hasattr(dcm, 'pixel_array'):
-        status = dcm.pixel_array.ndim == 3 
+    if not has_pixels(dcm):
+        return False
 
-    return status
+    # --- decode pixels only if header is ambiguous
+    ndim = infer_ndim(dcm)
+    if ndim is None:
+        pixels = read_pixels(dcm)
+
+        return pixels is not None and pixels.ndim == 3
+
+    return ndim == 3
 
 def check_desc(dcm, path):
     """
@@ -216,11 +394,101 @@ RULES['XR'] = {}
 RULES['NM'] = {}
 RULES['SR'] = {}
 
+def apply_rules(dcm, path, skip=[]):
+    """
+    Method to apply RULES to a single DICOM (except rules named in skip)
+
+    Returns a (verdict, message) tuple where verdict is one of:
+
+      'ANON' : keep DICOM
+      'QUAR' : move DICOM to quarantine
+      'ERRS' : DICOM cannot be checked (reason in message)
+
+    """
+    if not hasattr(dcm, 'Modality'):
+        return 'ERRS', 'modality header not in DICOM'
+
+    modality = dcm.Modality
+    if modality not in RULES:
+        return 'ERRS', 'modality not defined (%s)' % modality
+
+    for name, func in RULES[modality].items():
+        if RULES['use'][name] and name not in skip:
+
+            # --- Move to quarantine 
+            if func(dcm, path):
+                return 'QUAR', None
+
+    return 'ANON', None
+
+def check_sorted(d):
+    """
+    Method to read and check a single DICOM in the sorted (two-step) layout
+
+    Returns (acc, series, verdict, message)
+
+    """
+    acc, series = d.split('/')[-3:-1]
+    try:
+        dcm = read_header(d)
+        verdict, message = apply_rules(dcm, d)
+    except:
+        verdict, message = 'ERRS', 'pydicom cannot open DICOM '
+
+    return acc, series, verdict, message
+
+def check_flat(d):
+    """
+    Method to read the header of and check a single unsorted DICOM (fused layout)
+
+    DEFERRED_RULES are not applied since the series index is not complete yet
+
+    Returns (acc, series, sop, verdict, message, deferred) where deferred lists 
+    the DEFERRED_RULES that still need to be applied
+
+    """
+    try:
+        dcm = read_header(d)
+        acc, series, sop = dcm.AccessionNumber, dcm.SeriesInstanceUID, dcm.SOPInstanceUID
+    except:
+        return '', None, None, 'ERRS', 'pydicom cannot open DICOM ', []
+
+    try:
+        verdict, message = apply_rules(dcm, d, skip=DEFERRED_RULES)
+    except:
+        verdict, message = 'ERRS', 'pydicom cannot open DICOM '
+
+    deferred = []
+    if verdict == 'ANON':
+        deferred = [name for name in DEFERRED_RULES if RULES['use'][name] and name in RULES[dcm.Modality]]
+
+    return acc, series, sop, verdict, message, deferred
+
+def map_dcms(func, dcms, workers=None):
+    """
+    Method to apply func to each DICOM path, optionally over a process pool
+
+    Results are yielded in the same order as dcms so logs are deterministic
+
+    :params
+
+      (int) workers : number of processes; if None, use the number of cores
+
+    """
+    workers = (os.cpu_count() or 1) if workers is None else workers
+
+    if workers > 1 and len(dcms) > 1:
+        chunksize = max(1, min(256, len(dcms) // (workers * 4)))
+        with multiprocessing.Pool(processes=workers, initializer=set_series_index, initargs=(SERIES_INDEX,)) as pool:
+            yield from pool.imap(func, dcms, chunksize=chunksize)
+    else:
+        yield from map(func, dcms)
+
 # ===============================================================
 # RUN ANONYMIZATION 
 # ===============================================================
 
-def run(root, log_name='anon.txt'):
+def run(root, log_name='anon.txt', workers=None):
     
     # --- modify root path
     root = root + '/sorted'
@@ -237,55 +505,35 @@ def run(root, log_name='anon.txt'):
     print('Saving logs to: %s' % log_path)
     log_file = open(log_path, 'w')
 
-    # --- Find all DICOMs
+    # --- Find all DICOMs and load number of instances per series
     dcms = glob.glob('%s/*/*/*.dcm' % root)
+    set_series_index(load_series_index(os.path.dirname(root)))
 
     # --- Create lists
     move_to_quar = []
     move_to_anon = []
+    folders = set()
 
     # --- Apply rules and move folders to anon/quarantine 
-    for count, d in enumerate(dcms):
+    results = map_dcms(check_sorted, dcms, workers=workers)
+    for count, (d, (acc, series, verdict, message)) in enumerate(zip(dcms, results)):
         print('Checking rules: %06i/%06i' % (count + 1, len(dcms)), end='\r')
 
-        acc, series = d.split('/')[-3:-1]
-        try:
-            dcm = pydicom.read_file(d)
-            
-            if dcm is not None:
-
-                if hasattr(dcm, 'Modality'):
-                    modality = dcm.Modality
-                    if modality in RULES:
-                        quar = False
-                        for name, func in RULES[modality].items():
-                            if RULES['use'][name]:
-
-                                # --- Move to quarantine 
-                                quar = func(dcm, d)
-                                if quar:
-                                    log_file.write('QUAR: %s | %s\n' % (acc, d))
-                                    dst = '%s/%s/%s' % (PATH_QUARANTINE, acc, series)
-                                    os.makedirs(dst, exist_ok=True)
-                                    move_to_quar.append((d, dst))
-                                    # shutil.move(src=d, dst=dst)
-                                    break
-
-                        # -- Move to anon 
-                        if not quar:
-                            log_file.write('ANON: %s | %s\n' % (acc, d))
-                            dst = '%s/%s/%s' % (PATH_ANON, acc, series)
-                            os.makedirs(dst, exist_ok=True)
-                            move_to_anon.append((d, dst))
-                            # shutil.move(src=d, dst=dst)
-
-                    else:
-                        log_file.write('ERRS: %s | %s | modality not defined (%s)\n' % (acc, d, modality))
-                else:
-                    log_file.write('ERRS: %s | %s | modality header not in DICOM\n' % (acc, d))
-
-        except:
-            log_file.write('ERRS: %s | %s | pydicom cannot open DICOM \n' % (acc, d))
+        if verdict == 'QUAR':
+            log_file.write('QUAR: %s | %s\n' % (acc, d))
+            dst = '%s/%s/%s' % (PATH_QUARANTINE, acc, series)
+            os.makedirs(dst, exist_ok=True)
+            move_to_quar.append((d, dst))
+
+        elif verdict == 'ANON':
+            log_file.write('ANON: %s | %s\n' % (acc, d))
+            dst = '%s/%s/%s' % (PATH_ANON, acc, series)
+            os.makedirs(dst, exist_ok=True)
+            move_to_anon.append((d, dst))
+            anon_folder(folders, PATH_ANON, acc, series)
+
+        else:
+            log_file.write('ERRS: %s | %s | %s\n' % (acc, d, message))
     print('Checking rules complete                                                             ')
 
     # --- Move the files
@@ -297,7 +545,105 @@ def run(root, log_name='anon.txt'):
 
     log_file.close()
 
-    return dcms
+    return sorted(folders)
+
+def run_fused(root, log_name='anon.txt', workers=None, source=None):
+    """
+    Method to sort and quarantine DICOMs in a single pass:
+
+      .../flat/**/*.dcm --> .../anon/accession/seriesUID/instanceUID.dcm
+                        --> .../quarantine/accession/seriesUID/instanceUID.dcm
+
+    Each DICOM header is read once (without pixels) and each file is moved once.
+    Files that cannot be checked are moved to .../sorted as in the two-step layout.
+    The number of instances per series is saved to .../sorted/series_index.json.
+
+    Returns the folders in .../anon that files were moved to (see anon_folder()).
+
+    :params
+
+      (str) source : folder to sort instead of .../flat (e.g. a single study); the
+        series index then only covers source and is not saved
+
+    """
+    PATH_SORTED = '%s/sorted' % root
+    PATH_QUARANTINE = '%s/quarantine' % root
+    PATH_ANON = '%s/anon' % root
+    PATH_LOGS = '%s/logs' % root
+    os.makedirs(PATH_QUARANTINE, exist_ok=True)
+    os.makedirs(PATH_ANON , exist_ok=True)
+    os.makedirs(PATH_LOGS, exist_ok=True)
+
+    # --- Open log file
+    log_path = '%s/%s' % (PATH_LOGS, log_name)
+    print('Saving logs to: %s' % log_path)
+    log_file = open(log_path, 'w')
+
+    # --- Find all DICOMs
+    source = '%s/flat' % root if source is None else source
+    dcms = glob.glob('%s/**/*.dcm' % source, recursive=True)
+
+    # --- Read headers, apply rules and find final destination
+    moves = []
+    results = []
+    folders = set()
+    for count, result in enumerate(map_dcms(check_flat, dcms, workers=workers)):
+        print('Sorting and checking rules: %06i/%06i' % (count + 1, len(dcms)), end='\r')
+        results.append(result)
+
+    # --- Save number of instances per series and apply deferred rules
+    set_series_index(build_series_index([r[:3] for r in results if r[1] is not None]))
+    if source == '%s/flat' % root:
+        write_series_index(SERIES_INDEX, root=root)
+
+    for d, (acc, series, sop, verdict, message, deferred) in zip(dcms, results):
+
+        # --- header could not be read, leave file in flat
+        if series is None:
+            log_file.write('ERRS: %s | %s | %s\n' % (acc, d, message))
+            continue
+
+        if 'small_series' in deferred and count_series(acc, series) <= SMALL_SERIES:
+            verdict = 'QUAR'
+
+        if verdict == 'QUAR':
+            log_file.write('QUAR: %s | %s\n' % (acc, d))
+            dst = '%s/%s/%s' % (PATH_QUARANTINE, acc, series)
+
+        elif verdict == 'ANON':
+            log_file.write('ANON: %s | %s\n' % (acc, d))
+            dst = '%s/%s/%s' % (PATH_ANON, acc, series)
+            anon_folder(folders, PATH_ANON, acc, series)
+
+        else:
+            log_file.write('ERRS: %s | %s | %s\n' % (acc, d, message))
+            dst = '%s/%s/%s' % (PATH_SORTED, acc, series)
+
+        moves.append((d, dst, '%s.dcm' % sop))
+
+    print('Sorting and checking rules complete                                                 ')
+
+    # --- Move the files
+    for n, (src, dst, fname) in enumerate(moves):
+        print('Moving files: %06i/%06i' % (n + 1, len(moves)), end='\r')
+        os.makedirs(dst, exist_ok=True)
+        shutil.move(src=src, dst='%s/%s' % (dst, fname))
+    print('Moving files complete                                                                ')
+
+    log_file.close()
+
+    return sorted(folders)
+
+def anon_folder(folders, root, acc, series):
+    """
+    Method to record the folder in root holding a series moved to anon: the
+    accession folder, or the series folder if the accession is empty
+
+    """
+    if len(str(acc).strip()) > 0:
+        folders.add('%s/%s' % (root, acc))
+    else:
+        folders.add(os.path.normpath('%s/%s/%s' % (root, acc, series)))
 
 def makedirs(path, root):
     """
@@ -308,23 +654,39 @@ def makedirs(path, root):
     os.makedirs('%s/%s' % (root, acc), exist_ok=True)
     os.makedirs('%s/%s/%s' % (root, acc, series), exist_ok=True)
 
-def sort(root):
+def sort(root, fused=True, workers=None, source=None, log_name='anon.txt'):
+    """
+    Method to sort and quarantine all DICOMs in root/flat
+
+    :params
+
+      (str) root : root folder containing flat/
+      (bool) fused : if True, sort and quarantine in a single header-only pass;
+        if False, use the two-step layout (flat --> sorted --> anon/quarantine)
+      (int) workers : number of processes used to check rules; if None, use the number of cores
+      (str) source : folder to sort instead of root/flat (fused only)
+      (str) log_name : name of the log file in root/logs
+
+    :return
+
+      (list) folders in root/anon that files were moved to
+
+    """
+    if fused:
+        return run_fused(root=root, log_name=log_name, workers=workers, source=source)
 
     # --- run sorting step
     dcms = sort_dcms(root=root)
 
     # --- run quarantine step
-    dcms = run(root=root, log_name='anon.txt')
+    return run(root=root, log_name=log_name, workers=workers)
     
 if __name__ == '__main__':
     
-    # --- extract root path from arguments
-    assert len(sys.argv) == 2
+    # --- extract root path (and optional --two-step flag) from arguments
+    assert len(sys.argv) in [2, 3]
 
     root = sys.argv[1]
 
-    # --- run sorting step
-    dcms = sort_dcms(root=root)
-
-    # --- run quarantine step
-    dcms = run(root=root, log_name='anon.txt')
+    # --- run sorting and quarantine steps
+    folders = sort(root=root, fused='--two-step' not in sys.argv)
@@ -0,0 +1,190 @@
+# --------------------------------------------------
+#  Processes each study as soon as its C-MOVE has
+#  finished, while later studies are still downloading:
+#
+#    PACS_DL_PATH/mrn/acc --> mirc/flat/mrn/acc
+#      --> sort / quarantine --> scrub secondaries
+#      --> anonymize tags
+#
+#  Studies run on a pool of workers, each study is
+#  processed with a single process. Output of each study
+#  is written to mirc/logs/stream/<acc>/.
+# --------------------------------------------------
+import os, glob, contextlib
+import multiprocessing
+
+import sorter_anonymizer
+import post_process
+import anonymize_dicoms
+
+# --- processing context of each worker process (set by set_context)
+CONTEXT = None
+
+class StudyPipeline():
+
+    def __init__(self, mirc_root, download_root, rules=None, anonymizer=None, workers=None, transfer_syntax=post_process.OUTPUT_TRANSFER_SYNTAX, memory_budget=post_process.MEMORY_BUDGET):
+        """
+        Starts the worker pool.
+
+        Parameters:
+        mirc_root - processing area containing flat/, anon/, quarantine/ and logs/
+        download_root - PACS download area (PACS_DL_PATH) sorted as mrn/accession/...
+        rules - RuleIndex used to scrub secondaries (None skips the scrub)
+        anonymizer - anonymize_dicoms.Anonymizer (None skips tag anonymization)
+        workers - number of studies processed at once; if None, use the number of cores
+        memory_budget - bytes of estimated pixel memory scrubbed at once by all studies together
+            (None uses half of physical memory, see post_process.MemoryBudget)
+        """
+        self.mirc_root = os.path.normpath(mirc_root)
+        self.download_root = os.path.normpath(download_root)
+        self.submitted = set()
+        self.jobs = []
+
+        context = {
+            'mirc_root': self.mirc_root,
+            'download_root': self.download_root,
+            'rules': rules,
+            'anonymizer': anonymizer,
+            'transfer_syntax': transfer_syntax,
+            'memory_budget': post_process.MemoryBudget(memory_budget)}
+
+        workers = (os.cpu_count() or 1) if workers is None else workers
+        self.pool = multiprocessing.Pool(processes=workers, initializer=set_context, initargs=(context,))
+
+    def submit(self, status):
+        """
+        Queues a study for processing (used as on_complete callback of
+        pacs_client.Client.perform_move). Failed moves are left for finish().
+        """
+        if status['status'] == 'failed':
+            return
+
+        self.add(str(status['mrn']), str(status['accession']))
+
+    def add(self, mrn, acc):
+
+        if (mrn, acc) in self.submitted:
+            return
+
+        self.submitted.add((mrn, acc))
+        self.jobs.append((acc, self.pool.apply_async(process_study, (mrn, acc))))
+
+    def wait(self, offsets):
+        """
+        Waits for all queued studies, merging the days shifted per PatientID into offsets.
+        """
+        for n, (acc, job) in enumerate(self.jobs):
+
+            try:
+                offsets.update(job.get())
+            except Exception as e:
+                print('\nSTREAM ERROR: ' + acc + ' | ' + str(e))
+
+            print('Processed studies: %06i/%06i' % (n + 1, len(self.jobs)), end='\r')
+
+        self.jobs = []
+        print('')
+
+    def finish(self):
+        """
+        Waits for all submitted studies, then processes everything still left
+        in the download area (failed or partial moves, files that arrived after
+        their study was processed, earlier downloads) and returns the days
+        shifted per PatientID.
+        """
+        offsets = {}
+        self.wait(offsets)
+
+        # --- sweep the download area, regardless of what was already processed
+        for path in sorted(glob.glob(self.download_root + '/*/*')):
+            if os.path.isdir(path):
+                mrn, acc = path.split('/')[-2:]
+                self.jobs.append((acc, self.pool.apply_async(process_study, (mrn, acc, 'anon_sweep'))))
+
+        self.wait(offsets)
+
+        self.pool.close()
+        self.pool.join()
+
+        return offsets
+
+def set_context(context):
+    """
+    Sets the processing context of the current process (used as process pool initializer).
+    """
+    global CONTEXT
+    CONTEXT = context
+
+def process_study(mrn, acc, log_name='anon'):
+    """
+    Moves a downloaded study into the processing area, then sorts, scrubs
+    and anonymizes it. Returns the days shifted per PatientID.
+
+    A study can be processed again (e.g. for files that arrived late), files
+    finished before are skipped using the journals of the study.
+    """
+    mirc_root = CONTEXT['mirc_root']
+    logs = '%s/logs/stream/%s' % (mirc_root, acc)
+    os.makedirs(logs, exist_ok=True)
+
+    with open(logs + '/output.txt', 'a') as output, contextlib.redirect_stdout(output):
+
+        # --- move study from PACS download area to PROCESS AREA
+        flat = '%s/flat/%s/%s' % (mirc_root, mrn, acc)
+        merge_folder('%s/%s/%s' % (CONTEXT['download_root'], mrn, acc), flat)
+
+        # --- sort and quarantine dicom files, files are filed under their header AccessionNumber
+        folders = sorter_anonymizer.sort(mirc_root, workers=1, source=flat, log_name='stream/%s/%s.txt' % (acc, log_name))
+
+        if len(folders) == 0:
+            print('No files left to anonymize.')
+            return {}
+
+        offsets = {}
+        for anon in folders:
+
+            # --- journals and logs named after the folder relative to mirc/anon
+            rel = os.path.relpath(anon, '%s/anon' % mirc_root)
+            name = rel.replace('/', '_')
+
+            # --- post process secondaries
+            if CONTEXT['rules'] is not None:
+                try:
+                    post_process.anonymize(anon, CONTEXT['rules'], resume=True, rescan=True, journal_path='%s/scrub_journal_%s.txt' % (logs, name),
+                        transfer_syntax=CONTEXT['transfer_syntax'], workers=1, shared_budget=CONTEXT['memory_budget'],
+                        quarantine_path='%s/quarantine/%s' % (mirc_root, rel), log_path='%s/scrub_%s.txt' % (logs, name))
+                except:
+                    print('POST PROCESS ERROR. Secondary scrub not performed.')
+
+            # --- anonymize dicom files
+            if CONTEXT['anonymizer'] is not None:
+                shifted = anonymize_dicoms.anonymize(anon, anonymizer=CONTEXT['anonymizer'], workers=1, resume=True,
+                    journal_path='%s/anonymize_journal_%s.txt' % (logs, name))
+                offsets.update(shifted or {})
+
+    return offsets
+
+def merge_folder(src, dst):
+    """
+    Moves all files of src into dst (which may already exist) keeping their
+    relative paths, then removes the emptied folders of src. Nothing is done
+    if src does not exist.
+
+    Files that arrive while merging are left in src for the sweep of finish().
+    """
+    if not os.path.isdir(src):
+        return
+
+    for root, directories, file_paths in os.walk(src):
+
+        folder = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(folder, exist_ok=True)
+        for file_path in file_paths:
+            os.replace(os.path.join(root, file_path), os.path.join(folder, file_path))
+
+    # --- remove empty folders bottom-up, keep any folder that received new files
+    for root, directories, file_paths in os.walk(src, topdown=False):
+        try:
+            os.rmdir(root)
+        except OSError:
+            pass